@@ -1,12 +1,206 @@
 """
 AI Service - Handles communication with Google Gemini API
 """
+import io
 import os
-import base64
-from typing import Optional, List, Dict
+import re
+import json
+import time
+import hashlib
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, AsyncIterator, Optional, List, Dict, Tuple
 
-from google import genai
-from google.genai import types
+from cachetools import LRUCache
+
+# google-genai takes most of a second to import, so it is only imported
+# once a Gemini API key is configured and a request needs it
+if TYPE_CHECKING:
+    from google.genai import types
+
+logger = logging.getLogger(__name__)
+
+# Context caching settings for the system prompt
+PROMPT_CACHE_TTL = 3600  # seconds
+PROMPT_CACHE_REFRESH_MARGIN = 60  # recreate the cache this long before it expires
+# Smallest prompt any Gemini model will cache, in tokens; models with a
+# higher minimum reject the cache and are remembered as unsupported
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_CHARS_PER_TOKEN = 4  # rough estimate for English text
+PROMPT_CACHE_RETRY_DELAY = 300  # seconds to wait after a failed cache creation
+
+# Chat sessions kept in memory, oldest evicted first
+MAX_CHAT_SESSIONS = 64
+
+# Screenshots uploaded through the Files API, remembered by content hash
+MAX_UPLOADED_IMAGES = 256
+UPLOADED_IMAGE_TTL = 47 * 3600  # seconds; Gemini keeps files for 48 hours
+
+# Generated titles remembered by a hash of their input
+TITLE_CACHE_SIZE = 1024
+
+# How much of the answer goes into an annotation's title prompt
+TITLE_ANSWER_CHARS = 300
+
+# Local title heuristic: inputs up to this many words, titled with up to
+# this many keywords
+HEURISTIC_TITLE_MAX_WORDS = 8
+HEURISTIC_TITLE_WORDS = 4
+HEURISTIC_TITLE_MIN_WORDS = 2  # fewer keywords than this are left to the model
+
+# Batch Mode settings for title generation
+TITLE_BATCH_INTERVAL = 0.2  # seconds to wait for more jobs before submitting
+TITLE_BATCH_MAX_JOBS = 50
+TITLE_BATCH_POLL_INTERVAL = 5.0  # seconds between batch job status checks
+
+# Row-marshaling settings: concurrent title requests share one prompt
+TITLE_MARSHAL_WINDOW = 0.05  # seconds to wait for concurrent jobs to arrive
+TITLE_MARSHAL_MAX_JOBS = 8  # returns diminish beyond ~8 rows per prompt
+
+# types.JobState names; JobState is a str enum, so these compare equal
+_BATCH_DONE_STATES = {
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+    "JOB_STATE_PARTIALLY_SUCCEEDED",
+}
+
+
+# Surrounding quotes and whitespace, plus prefixes the model might add
+_TITLE_PREFIX_RE = re.compile(r"^[\s\"']*(?:(?:[Tt]itle:|\*\*|##)\s*)*")
+_TITLE_SUFFIX_RE = re.compile(r"[\s\"']+$")
+
+
+def _clean_title(text: Optional[str]) -> Optional[str]:
+    """Tidy up a model-generated title, returning None if nothing is left."""
+    if not text:
+        return None
+    title = _TITLE_SUFFIX_RE.sub("", _TITLE_PREFIX_RE.sub("", text))
+    # Limit length
+    if len(title) > 50:
+        title = title[:47] + "..."
+    return title if title else None
+
+
+# Words left out of heuristic titles
+_TITLE_STOPWORDS = frozenset("""
+a about an and are as at be but by can could do does did for from how i if in
+into is it its me my of on or our please so that the their then there these
+this those to us was we were what when where which who why will with would you
+your
+""".split())
+_TITLE_WORD_RE = re.compile(r"[A-Za-z0-9][\w'-]*")
+# "Define X", "What is X" and the like, where X makes a fine title
+_TITLE_DEFINITION_RE = re.compile(r"^\s*(?:define|what\s+(?:is|are)|explain)\s+(.+)$", re.IGNORECASE | re.DOTALL)
+
+
+def _heuristic_title(text: str) -> Optional[str]:
+    """Build a title locally from a short question or highlight.
+    
+    Returns None for longer inputs, and ones with too few keywords, which
+    are left to the model. A definition question names its subject, so one
+    keyword is enough there.
+    """
+    match = _TITLE_DEFINITION_RE.match(text)
+    min_words = HEURISTIC_TITLE_MIN_WORDS
+    if match:
+        text = match.group(1)
+        min_words = 1
+    elif len(_TITLE_WORD_RE.findall(text)) > HEURISTIC_TITLE_MAX_WORDS:
+        return None
+    
+    keywords = [w for w in _TITLE_WORD_RE.findall(text) if w.lower() not in _TITLE_STOPWORDS]
+    # "How does this work?" would give just "Work": short questions like
+    # that are about the screenshot, which only the model sees
+    if len(keywords) < min_words:
+        return None
+    # Keep words like "LaTeX" or "GPU" as written
+    title = " ".join(w.capitalize() if w.islower() else w for w in keywords[:HEURISTIC_TITLE_WORDS])
+    return _clean_title(title)
+
+
+def _title_cache_key(*parts: str) -> str:
+    """Hash the inputs of a title prompt into a cache key."""
+    return hashlib.blake2b("\x00".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+@dataclass
+class _ChatSession:
+    """A Gemini chat session kept alive for one annotation."""
+    chat: object  # genai AsyncChat
+    model: str
+    cache_name: Optional[str]
+    has_image: bool = False
+    # Question/answer exchanges the session holds, including the history it
+    # was started with. Not len(chat.get_history()): a streamed answer is
+    # recorded as one history entry per chunk.
+    turns: int = 0
+
+
+class _TitleBatcher:
+    """Coalesces concurrent title requests into a single multi-item prompt."""
+    
+    def __init__(self, service: "AIService", max_jobs: int = TITLE_MARSHAL_MAX_JOBS):
+        self._service = service
+        self._max_jobs = max_jobs
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+    
+    async def submit(self, kind: str, item: str, prompt: str) -> Optional[str]:
+        """Queue a title job and wait for its title.
+        
+        `item` is the job's line in a combined prompt, `prompt` is the
+        stand-alone prompt used when the job ends up on its own.
+        """
+        loop = asyncio.get_running_loop()
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        
+        future = loop.create_future()
+        self._queue.put_nowait((kind, item, prompt, future))
+        if self._worker is None or self._worker.done():
+            self._worker = loop.create_task(self._run())
+        
+        return await future
+    
+    async def _run(self):
+        """Drain the queue in groups of up to max_jobs."""
+        while not self._queue.empty():
+            # Give concurrent requests a moment to join the group
+            await asyncio.sleep(TITLE_MARSHAL_WINDOW)
+            
+            jobs = []
+            while len(jobs) < self._max_jobs and not self._queue.empty():
+                jobs.append(self._queue.get_nowait())
+            
+            task = asyncio.create_task(self._resolve(jobs))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+    
+    async def _resolve(self, jobs: List[tuple]):
+        """Generate titles for a group of jobs and hand them to the waiting callers."""
+        try:
+            titles = None
+            if len(jobs) > 1:
+                titles = await self._service._generate_marshaled_titles(
+                    [item for _, item, _, _ in jobs]
+                )
+            if titles is None:
+                # Single job, or the combined response couldn't be parsed
+                titles = await asyncio.gather(*(
+                    self._service._generate_single_title(kind, prompt)
+                    for kind, _, prompt, _ in jobs
+                ))
+        except Exception:
+            logger.exception("Title batching error")
+            titles = [None] * len(jobs)
+        
+        for (_, _, _, future), title in zip(jobs, titles):
+            if not future.done():
+                future.set_result(title)
 
 
 class AIService:
@@ -17,8 +211,58 @@ class AIService:
         self.current_model = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
         self._cached_models = None
         
+        # Batch Mode is cheaper but can take a while to turn around, so it is opt-in
+        self.use_title_batch = os.getenv("GEMINI_TITLE_BATCH", "0") == "1"
+        # Title short questions and highlights locally instead of asking the model
+        self.use_title_heuristic = os.getenv("GEMINI_TITLE_HEURISTIC", "0") == "1"
+        self._title_jobs: List[tuple] = []
+        self._title_jobs_full = asyncio.Event()
+        self._title_batch_task: Optional[asyncio.Task] = None
+        self._title_batch_runs: set = set()
+        self._title_batcher = _TitleBatcher(self)
+        self._title_cache = LRUCache(maxsize=TITLE_CACHE_SIZE)
+        
+        # Name of the cached system prompt, per model
+        self._prompt_cache: Optional[str] = None
+        self._prompt_cache_model: Optional[str] = None
+        self._prompt_cache_expires_at = 0.0
+        self._prompt_cache_unsupported: set = set()
+        # Model -> time.monotonic() before which cache creation isn't retried
+        self._prompt_cache_retry_at: Dict[str, float] = {}
+        
+        # Chat sessions by annotation ID
+        self._chats: Dict[str, _ChatSession] = {}
+        
+        # Uploaded screenshots: content hash -> (file URI, expiry time)
+        self._uploaded_images: Dict[str, tuple] = {}
+        
+        # Earlier question/answer turns sent along with a new question
+        # (0 sends the whole history)
+        self.max_history_turns = int(os.getenv("GEMINI_HISTORY_TURNS", "8"))
+        
+        # Requests in flight to Gemini at once, to stay within rate limits
+        max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+        self._request_slots = asyncio.Semaphore(max_concurrency)
+        
         if os.getenv("GEMINI_API_KEY"):
-            self.gemini_client = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+            import httpx
+            from google import genai
+            from google.genai import types
+            
+            # Share one pooled HTTP client so concurrent requests don't queue
+            # up waiting for a connection
+            pool_size = max(int(os.getenv("GEMINI_POOL_SIZE", "100")), max_concurrency)
+            limits = httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=max(1, pool_size // 2)
+            )
+            self.gemini_client = genai.Client(
+                api_key=os.getenv("GEMINI_API_KEY"),
+                http_options=types.HttpOptions(
+                    client_args={"limits": limits},
+                    async_client_args={"limits": limits}
+                )
+            )
         
         # System prompt for academic paper analysis
         self.system_prompt = """You are an expert academic assistant helping a researcher understand scientific papers. You have expertise in mathematics, physics, computer science, and related fields.
@@ -32,7 +276,7 @@ When analyzing content from papers:
 
 The user will share excerpts from academic papers (as text or images) and ask questions. Help them understand the material deeply."""
 
-    def _fetch_available_models(self) -> List[Dict]:
+    async def _fetch_available_models(self) -> List[Dict]:
         """Fetch available models from Gemini API."""
         if not self.gemini_client:
             return []
@@ -42,7 +286,7 @@ The user will share excerpts from academic papers (as text or images) and ask qu
         
         models = []
         try:
-            for model in self.gemini_client.models.list():
+            async for model in await self.gemini_client.aio.models.list():
                 # Filter for models that can generate content
                 if "generateContent" in model.supported_actions:
                     models.append({
@@ -55,7 +299,7 @@ The user will share excerpts from academic papers (as text or images) and ask qu
             models.sort(key=lambda m: m["name"])
             self._cached_models = models
         except Exception as e:
-            print(f"Error fetching models: {e}")
+            logger.warning("Error fetching models: %s", e)
             # Fallback to a known model
             models = [{"id": "gemini-2.5-flash", "name": "Gemini 2.5 Flash", "description": "Default model"}]
         
@@ -65,7 +309,7 @@ The user will share excerpts from academic papers (as text or images) and ask qu
         """Check if Gemini is configured."""
         return self.gemini_client is not None
     
-    def get_available_providers(self) -> List[Dict]:
+    async def get_available_providers(self) -> List[Dict]:
         """Get list of available providers based on configured API keys."""
         providers = []
         
@@ -73,11 +317,21 @@ The user will share excerpts from academic papers (as text or images) and ask qu
             providers.append({
                 "id": "gemini",
                 "name": "Google Gemini",
-                "models": self._fetch_available_models()
+                "models": await self._fetch_available_models()
             })
         
         return providers
     
+    async def aclose(self):
+        """Stop pending title batches and close the shared Gemini HTTP client,
+        e.g. on shutdown."""
+        if self._title_batch_task is not None:
+            self._title_batch_task.cancel()
+        for task in list(self._title_batch_runs):
+            task.cancel()
+        if self.gemini_client:
+            await self.gemini_client.aio.aclose()
+    
     def refresh_models(self):
         """Clear the cached models to force a refresh."""
         self._cached_models = None
@@ -85,6 +339,12 @@ The user will share excerpts from academic papers (as text or images) and ask qu
     def set_model(self, provider: str, model_id: str):
         """Set the current model."""
         self.current_model = model_id
+        # Sessions are bound to the model they were created with
+        self._chats.clear()
+    
+    def forget_chat(self, annotation_id: str):
+        """Drop the chat session for an annotation, e.g. after its history was edited."""
+        self._chats.pop(annotation_id, None)
     
     def get_current_model(self) -> Dict:
         """Get the current provider and model."""
@@ -96,26 +356,188 @@ The user will share excerpts from academic papers (as text or images) and ask qu
     async def ask(
         self,
         question: str,
-        image_base64: Optional[str] = None,
+        image: Optional[bytes] = None,
         context: Optional[str] = None,
-        chat_history: Optional[List[dict]] = None
-    ) -> str:
-        """Ask a question, optionally with an image and context."""
+        chat_history: Optional[List[dict]] = None,
+        annotation_id: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """Ask a question, optionally with a PNG image and context.
+        
+        Yields the answer text as it is generated. Only the last
+        max_history_turns turns of chat_history are sent. With an
+        annotation_id, the chat session for that annotation is reused as long
+        as it still matches chat_history, so earlier turns don't have to be
+        rebuilt on every call.
+        """
+        from google.genai import errors
         
         if not self.gemini_client:
             raise ValueError("Gemini API not configured")
         
-        # Build the contents for Gemini
-        contents = []
+        if chat_history and self.max_history_turns > 0:
+            # Each turn is a user message plus the answer
+            chat_history = chat_history[-2 * self.max_history_turns:]
         
-        # Add chat history if present
-        if chat_history:
-            for msg in chat_history:
-                role = "user" if msg["role"] == "user" else "model"
-                contents.append(types.Content(
-                    role=role,
-                    parts=[types.Part.from_text(text=msg["content"])]
-                ))
+        # Reuse the cached system prompt when we have one
+        cache_name = await self._get_prompt_cache()
+        session = self._get_chat_session(annotation_id, chat_history, cache_name)
+        
+        started = False
+        try:
+            async for text in self._stream_chat_message(session, question, image, context):
+                started = True
+                yield text
+        except errors.ClientError as e:
+            if started or not session.cache_name or e.code not in (403, 404):
+                raise
+            # The cache expired or was deleted server-side; send the prompt
+            # inline this time and recreate the cache on the next call
+            self._prompt_cache = None
+            session = self._start_chat_session(annotation_id, chat_history, None)
+            async for text in self._stream_chat_message(session, question, image, context):
+                yield text
+
+    def ask_and_title(
+        self,
+        question: str,
+        image: Optional[bytes] = None,
+        context: Optional[str] = None,
+        chat_history: Optional[List[dict]] = None,
+        annotation_id: Optional[str] = None,
+        with_title: bool = True
+    ) -> Tuple[AsyncIterator[str], "asyncio.Future[Optional[str]]"]:
+        """Ask a question and generate a title for the exchange alongside it.
+        
+        Returns the answer stream (as from ask()) and a future for the title.
+        The title prompt only uses the start of the answer, so it is sent as
+        soon as that has streamed in, while the rest is still generating. The
+        future resolves to None without with_title or if generation fails.
+        """
+        title = asyncio.get_running_loop().create_future()
+        stream = self._ask_with_title(
+            title, question, image, context, chat_history, annotation_id, with_title
+        )
+        return stream, title
+
+    async def _ask_with_title(
+        self,
+        title: asyncio.Future,
+        question: str,
+        image: Optional[bytes],
+        context: Optional[str],
+        chat_history: Optional[List[dict]],
+        annotation_id: Optional[str],
+        with_title: bool
+    ) -> AsyncIterator[str]:
+        """Stream an answer for ask_and_title(), starting the title on the way."""
+        parts = []
+        length = 0
+        title_task = None
+        try:
+            async for text in self.ask(question, image, context, chat_history, annotation_id):
+                parts.append(text)
+                length += len(text)
+                if with_title and title_task is None and length >= TITLE_ANSWER_CHARS:
+                    title_task = asyncio.create_task(self._resolve_title(title, question, "".join(parts)))
+                yield text
+            
+            # Short answers: the whole answer goes into the prompt
+            if with_title and title_task is None:
+                title_task = asyncio.create_task(self._resolve_title(title, question, "".join(parts)))
+        except BaseException:
+            # No exchange to title if the answer failed or was abandoned
+            if title_task is not None:
+                title_task.cancel()
+            if not title.done():
+                title.set_result(None)
+            raise
+        finally:
+            if title_task is None and not title.done():
+                title.set_result(None)
+
+    async def _resolve_title(self, title: asyncio.Future, question: str, answer: str):
+        """Generate an annotation title and hand it to the given future."""
+        try:
+            result = await self.generate_title(question=question, answer=answer)
+        except Exception:
+            logger.exception("Error generating title")
+            result = None
+        if not title.done():
+            title.set_result(result)
+
+    def _get_chat_session(
+        self,
+        annotation_id: Optional[str],
+        chat_history: Optional[List[dict]],
+        cache_name: Optional[str]
+    ) -> _ChatSession:
+        """Get the live session for an annotation, or start a new one from chat_history."""
+        session = self._chats.get(annotation_id) if annotation_id else None
+        
+        if (
+            session
+            and session.model == self.current_model
+            and session.cache_name == cache_name
+            and 2 * session.turns == len(chat_history or [])
+        ):
+            # Move to the end so the least recently used session is evicted first
+            self._chats[annotation_id] = self._chats.pop(annotation_id)
+            return session
+        
+        return self._start_chat_session(annotation_id, chat_history, cache_name)
+
+    def _start_chat_session(
+        self,
+        annotation_id: Optional[str],
+        chat_history: Optional[List[dict]],
+        cache_name: Optional[str]
+    ) -> _ChatSession:
+        """Start a chat session seeded with chat_history."""
+        from google.genai import types
+        
+        history = []
+        for msg in chat_history or []:
+            role = "user" if msg["role"] == "user" else "model"
+            history.append(types.Content(
+                role=role,
+                parts=[types.Part.from_text(text=msg["content"])]
+            ))
+        
+        chat = self.gemini_client.aio.chats.create(
+            model=self.current_model,
+            config=self._ask_config(cache_name),
+            history=history
+        )
+        session = _ChatSession(
+            chat=chat,
+            model=self.current_model,
+            cache_name=cache_name,
+            turns=len(history) // 2
+        )
+        
+        if annotation_id:
+            self._chats.pop(annotation_id, None)
+            self._chats[annotation_id] = session
+            while len(self._chats) > MAX_CHAT_SESSIONS:
+                self._chats.pop(next(iter(self._chats)))
+        
+        return session
+
+    async def _stream_chat_message(
+        self,
+        session: _ChatSession,
+        question: str,
+        image: Optional[bytes],
+        context: Optional[str]
+    ) -> AsyncIterator[str]:
+        """Send the next user turn on a chat session, yielding the answer as it streams in."""
+        from google.genai import types
+        
+        # The session already carries the screenshot from an earlier turn, so
+        # skip it along with the context describing it
+        if image and session.has_image:
+            image = None
+            context = None
         
         # Build the current message parts
         parts = []
@@ -123,32 +545,118 @@ The user will share excerpts from academic papers (as text or images) and ask qu
         if context:
             parts.append(types.Part.from_text(text=f"Context:\n{context}\n\n"))
         
-        if image_base64:
-            # Decode base64 to bytes for Gemini
-            image_bytes = base64.b64decode(image_base64)
-            parts.append(types.Part.from_bytes(
-                data=image_bytes,
-                mime_type="image/png"
-            ))
+        if image:
+            parts.append(await self._image_part(image))
         
         parts.append(types.Part.from_text(text=question))
         
-        contents.append(types.Content(role="user", parts=parts))
+        async with self._request_slots:
+            async for chunk in await session.chat.send_message_stream(parts):
+                if chunk.text:
+                    yield chunk.text
         
-        # Configure the request
-        config = types.GenerateContentConfig(
+        session.turns += 1
+        if image:
+            session.has_image = True
+
+    async def _image_part(self, image: bytes) -> "types.Part":
+        """Build the message part for a screenshot.
+        
+        The image is uploaded through the Files API once and referenced by URI
+        afterwards, so neither the session history nor later sessions for the
+        same screenshot carry the image bytes. Falls back to inline bytes if
+        the upload fails.
+        """
+        from google.genai import types
+        
+        key = hashlib.blake2b(image, digest_size=16).hexdigest()
+        uploaded = self._uploaded_images.get(key)
+        if uploaded and time.monotonic() < uploaded[1]:
+            return types.Part.from_uri(file_uri=uploaded[0], mime_type="image/png")
+        
+        try:
+            async with self._request_slots:
+                file = await self.gemini_client.aio.files.upload(
+                    file=io.BytesIO(image),
+                    config=types.UploadFileConfig(mime_type="image/png")
+                )
+        except Exception as e:
+            logger.warning("Image upload error, sending the image inline: %s", e)
+            return types.Part.from_bytes(data=image, mime_type="image/png")
+        
+        self._uploaded_images.pop(key, None)
+        self._uploaded_images[key] = (file.uri, time.monotonic() + UPLOADED_IMAGE_TTL)
+        while len(self._uploaded_images) > MAX_UPLOADED_IMAGES:
+            self._uploaded_images.pop(next(iter(self._uploaded_images)))
+        
+        return types.Part.from_uri(file_uri=file.uri, mime_type="image/png")
+
+    def _ask_config(self, cache_name: Optional[str]) -> "types.GenerateContentConfig":
+        """Build the generation config for ask(), with or without a cached system prompt."""
+        from google.genai import types
+        
+        if cache_name:
+            return types.GenerateContentConfig(
+                cached_content=cache_name,
+                temperature=0.7
+            )
+        return types.GenerateContentConfig(
             system_instruction=self.system_prompt,
             temperature=0.7
         )
+
+    async def _get_prompt_cache(self) -> Optional[str]:
+        """Get (creating if needed) the context cache holding the system prompt.
         
-        # Generate response
-        response = self.gemini_client.models.generate_content(
-            model=self.current_model,
-            contents=contents,
-            config=config
-        )
+        Returns None if the current model can't cache the prompt, e.g. when
+        it is shorter than the model's minimum cacheable size, or for a while
+        after creating the cache failed.
+        """
+        from google.genai import errors, types
+        
+        # Too short to cache: don't spend a round trip finding that out
+        if len(self.system_prompt) < PROMPT_CACHE_MIN_TOKENS * PROMPT_CACHE_CHARS_PER_TOKEN:
+            return None
+        
+        model = self.current_model
+        if model in self._prompt_cache_unsupported:
+            return None
+        if time.monotonic() < self._prompt_cache_retry_at.get(model, 0.0):
+            return None
+        
+        if (
+            self._prompt_cache
+            and self._prompt_cache_model == model
+            and time.monotonic() < self._prompt_cache_expires_at - PROMPT_CACHE_REFRESH_MARGIN
+        ):
+            return self._prompt_cache
         
-        return response.text
+        try:
+            async with self._request_slots:
+                cache = await self.gemini_client.aio.caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        system_instruction=self.system_prompt,
+                        ttl=f"{PROMPT_CACHE_TTL}s"
+                    )
+                )
+        except errors.ClientError as e:
+            # Rejected outright (too few tokens, unsupported model): stop trying
+            logger.info("Context caching unavailable for %s: %s", model, e)
+            self._prompt_cache_unsupported.add(model)
+            self._prompt_cache = None
+            return None
+        except Exception as e:
+            # Likely transient; send the prompt inline until the retry delay passes
+            logger.warning("Error creating context cache: %s", e)
+            self._prompt_cache_retry_at[model] = time.monotonic() + PROMPT_CACHE_RETRY_DELAY
+            self._prompt_cache = None
+            return None
+        
+        self._prompt_cache = cache.name
+        self._prompt_cache_model = model
+        self._prompt_cache_expires_at = time.monotonic() + PROMPT_CACHE_TTL
+        return self._prompt_cache
     
     async def generate_title(
         self,
@@ -161,48 +669,34 @@ The user will share excerpts from academic papers (as text or images) and ask qu
         if not self.gemini_client:
             raise ValueError("Gemini API not configured")
         
+        if self.use_title_heuristic:
+            title = _heuristic_title(question)
+            if title:
+                return title
+        
         # Build a simple text-only prompt for title generation
         # Don't include image to keep it simple and fast
         prompt = f"""Generate a SHORT title (3-6 words) for this Q&A about an academic paper. Return ONLY the title, nothing else.
 
 Question: {question}
 
-Answer: {answer[:300]}
+Answer: {answer[:TITLE_ANSWER_CHARS]}
 
 Title:"""
         
-        contents = [types.Content(
-            role="user",
-            parts=[types.Part.from_text(text=prompt)]
-        )]
+        key = _title_cache_key("annotation", question, answer[:TITLE_ANSWER_CHARS])
+        if key in self._title_cache:
+            return self._title_cache[key]
         
-        config = types.GenerateContentConfig(
-            temperature=0.3
-        )
+        if self.use_title_batch:
+            title = await self.enqueue_title_job("annotation", prompt)
+        else:
+            item = f"Q: {question} A: {answer[:TITLE_ANSWER_CHARS]}"
+            title = await self._title_batcher.submit("annotation", item, prompt)
         
-        try:
-            response = self.gemini_client.models.generate_content(
-                model=self.current_model,
-                contents=contents,
-                config=config
-            )
-            
-# Check for valid response
-            if response and response.text:
-                title = response.text.strip().strip('"').strip("'").strip()
-                # Remove common prefixes the model might add
-                for prefix in ["Title:", "title:", "**", "##"]:
-                    if title.startswith(prefix):
-                        title = title[len(prefix):].strip()
-                # Limit length
-                if len(title) > 50:
-                    title = title[:47] + "..."
-                return title if title else None
-            else:
-                return None
-        except Exception as e:
-            print(f"Title generation error: {e}")
-            return None
+        if title:
+            self._title_cache[key] = title
+        return title
 
     async def generate_note_title(
         self,
@@ -214,6 +708,11 @@ Title:"""
         if not self.gemini_client:
             raise ValueError("Gemini API not configured")
         
+        if self.use_title_heuristic:
+            title = _heuristic_title(selected_text)
+            if title:
+                return title
+        
         # Build a simple prompt for note title generation
         prompt = f"""Generate a SHORT title (3-5 words) that summarizes this highlighted text from an academic paper. Return ONLY the title, nothing else.
 
@@ -221,6 +720,24 @@ Highlighted text: {selected_text[:500]}
 
 Title:"""
         
+        key = _title_cache_key("note", selected_text[:500])
+        if key in self._title_cache:
+            return self._title_cache[key]
+        
+        if self.use_title_batch:
+            title = await self.enqueue_title_job("note", prompt)
+        else:
+            item = f"Highlighted text: {selected_text[:500]}"
+            title = await self._title_batcher.submit("note", item, prompt)
+        
+        if title:
+            self._title_cache[key] = title
+        return title
+
+    async def _generate_single_title(self, kind: str, prompt: str) -> Optional[str]:
+        """Generate one title from a stand-alone title prompt."""
+        from google.genai import types
+        
         contents = [types.Content(
             role="user",
             parts=[types.Part.from_text(text=prompt)]
@@ -231,24 +748,145 @@ Title:"""
         )
         
         try:
-            response = self.gemini_client.models.generate_content(
+            async with self._request_slots:
+                response = await self.gemini_client.aio.models.generate_content(
+                    model=self.current_model,
+                    contents=contents,
+                    config=config
+                )
+            return _clean_title(response.text if response else None)
+        except Exception as e:
+            label = "Note title" if kind == "note" else "Title"
+            logger.warning("%s generation error: %s", label, e)
+            return None
+
+    async def _generate_marshaled_titles(self, items: List[str]) -> Optional[List[Optional[str]]]:
+        """Generate titles for several items with one prompt.
+        
+        Returns None if the response isn't a JSON array with one title per item.
+        """
+        from google.genai import types
+        
+        numbered = "\n".join(f"{i}) {item}" for i, item in enumerate(items, start=1))
+        prompt = f"""Generate a SHORT title (3-6 words) for each of these items from an academic paper. Return ONLY a JSON array of {len(items)} strings, one title per item, in the same order.
+
+{numbered}
+"""
+        
+        contents = [types.Content(
+            role="user",
+            parts=[types.Part.from_text(text=prompt)]
+        )]
+        
+        # No max_output_tokens: on thinking models the thoughts count against
+        # it, and a cap sized for the titles can run out before any text
+        config = types.GenerateContentConfig(
+            temperature=0.3,
+            response_mime_type="application/json"
+        )
+        
+        try:
+            async with self._request_slots:
+                response = await self.gemini_client.aio.models.generate_content(
+                    model=self.current_model,
+                    contents=contents,
+                    config=config
+                )
+            titles = json.loads(response.text)
+        except Exception as e:
+            logger.warning("Combined title generation error: %s", e)
+            return None
+        
+        if not isinstance(titles, list) or len(titles) != len(items):
+            return None
+        return [_clean_title(t) if isinstance(t, str) else None for t in titles]
+
+    # ============================================
+    # Batch Mode title generation
+    # ============================================
+
+    def enqueue_title_job(self, kind: str, prompt: str) -> asyncio.Future:
+        """Queue a title prompt for the next Batch Mode job.
+        
+        Returns a future that resolves to the cleaned title (or None on failure).
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._title_jobs.append((kind, prompt, future))
+        
+        if len(self._title_jobs) >= TITLE_BATCH_MAX_JOBS:
+            self._title_jobs_full.set()
+        if self._title_batch_task is None or self._title_batch_task.done():
+            self._title_batch_task = loop.create_task(self._run_title_batches())
+        
+        return future
+
+    async def _run_title_batches(self):
+        """Collect queued title jobs and start a Batch Mode job for each batch."""
+        while self._title_jobs:
+            # Give concurrent requests a moment to join the batch
+            try:
+                await asyncio.wait_for(self._title_jobs_full.wait(), TITLE_BATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            
+            jobs = self._title_jobs[:TITLE_BATCH_MAX_JOBS]
+            del self._title_jobs[:TITLE_BATCH_MAX_JOBS]
+            if len(self._title_jobs) < TITLE_BATCH_MAX_JOBS:
+                self._title_jobs_full.clear()
+            
+            # Each batch waits for its results on its own, so jobs queued
+            # meanwhile don't wait for it before being submitted
+            task = asyncio.create_task(self._run_title_batch(jobs))
+            self._title_batch_runs.add(task)
+            task.add_done_callback(self._title_batch_runs.discard)
+    
+    async def _run_title_batch(self, jobs: List[tuple]):
+        """Submit one Batch Mode job and hand its titles to the job futures."""
+        titles = [None] * len(jobs)
+        try:
+            titles = await self._submit_title_batch(jobs)
+        except Exception as e:
+            logger.warning("Title batch error: %s", e)
+        finally:
+            # Also on cancellation, so nothing is left waiting for a title
+            for (_, _, future), title in zip(jobs, titles):
+                if not future.done():
+                    future.set_result(title)
+
+    async def _submit_title_batch(self, jobs: List[tuple]) -> List[Optional[str]]:
+        """Run one Batch Mode job for the given title jobs and wait for its results."""
+        src = [
+            {
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "config": {"temperature": 0.3}
+            }
+            for _, prompt, _ in jobs
+        ]
+        
+        async with self._request_slots:
+            batch_job = await self.gemini_client.aio.batches.create(
                 model=self.current_model,
-                contents=contents,
-                config=config
+                src=src
             )
-            
-            if response and response.text:
-                title = response.text.strip().strip('"').strip("'").strip()
-                # Remove common prefixes the model might add
-                for prefix in ["Title:", "title:", "**", "##"]:
-                    if title.startswith(prefix):
-                        title = title[len(prefix):].strip()
-                # Limit length
-                if len(title) > 50:
-                    title = title[:47] + "..."
-                return title if title else None
+        
+        while batch_job.state not in _BATCH_DONE_STATES:
+            await asyncio.sleep(TITLE_BATCH_POLL_INTERVAL)
+            async with self._request_slots:
+                batch_job = await self.gemini_client.aio.batches.get(name=batch_job.name)
+        
+        if batch_job.state not in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            raise RuntimeError(f"Batch job {batch_job.name} ended in state {batch_job.state}")
+        
+        responses = (batch_job.dest.inlined_responses if batch_job.dest else None) or []
+        titles = []
+        for (kind, _, _), item in zip(jobs, responses):
+            if item.error or not item.response:
+                logger.warning("%s title generation error: %s", kind.capitalize(), item.error)
+                titles.append(None)
             else:
-                return None
-        except Exception as e:
-            print(f"Note title generation error: {e}")
-            return None
\ No newline at end of file
+                titles.append(_clean_title(item.response.text))
+        
+        # Pad in case the batch returned fewer responses than requests
+        titles.extend([None] * (len(jobs) - len(titles)))
+        return titles
\ No newline at end of file
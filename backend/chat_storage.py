@@ -1,46 +1,78 @@
 """
 Chat Storage - Handles persistence of annotations and chat history to .chat files
+
+Each PDF has a .chat snapshot plus a .chat.log journal. Changes are appended
+to the journal as one JSON record per line and folded back into the snapshot
+once the journal grows long. Loading replays the journal over the snapshot.
+Screenshots are kept as PNG files in a .chat.d folder next to them.
 """
-import json
-import uuid
+import os
+import secrets
+import asyncio
+import logging
+import binascii
+import tempfile
 from pathlib import Path
+from collections import deque
 from datetime import datetime
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Union
 from dataclasses import dataclass, field
 
+import anyio
+import msgspec
+from cachetools import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# How long to wait after a change before writing the .chat file, so a
+# burst of edits is saved in one go
+SAVE_DEBOUNCE_DELAY = 0.5  # seconds
+# ...unless this many changes pile up first
+SAVE_MAX_PENDING_RECORDS = 50
+
+# Rewrite the snapshot once the journal has this many records
+JOURNAL_COMPACT_RECORDS = 200
+
+# Chat files kept in memory; ones with unsaved changes are always kept
+CHAT_CACHE_SIZE = 32
+# Screenshots kept in memory, most recently used first
+IMAGE_CACHE_SIZE = 16
+
+# PDF paths may be given as str or Path; they are normalized to str
+StrPath = Union[str, "os.PathLike[str]"]
+
+# Flushes a file's data to disk. fdatasync skips metadata like the
+# modification time that isn't needed to read the data back; it doesn't
+# exist on macOS or Windows.
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+# New message IDs are generated this many at a time
+MESSAGE_ID_BATCH = 128
+_message_ids: deque = deque()
+
+
+def _new_message_id() -> str:
+    """Get a random 32 character hex ID for a new message."""
+    if not _message_ids:
+        # One urandom call for the whole batch instead of one per message
+        ids = secrets.token_hex(16 * MESSAGE_ID_BATCH)
+        _message_ids.extend(ids[i:i + 32] for i in range(0, len(ids), 32))
+    return _message_ids.popleft()
 
-@dataclass
+
+@dataclass(slots=True)
 class Message:
     """A single message in a chat."""
     role: str  # "user" or "assistant"
     content: str
-    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = field(default_factory=_new_message_id)
     timestamp: str = field(default_factory=lambda: datetime.now().isoformat())
-    image_base64: Optional[str] = None  # Only for user messages with screenshots
-    
-    def to_dict(self) -> dict:
-        d = {
-            "id": self.id,
-            "role": self.role,
-            "content": self.content,
-            "timestamp": self.timestamp
-        }
-        if self.image_base64:
-            d["image_base64"] = self.image_base64
-        return d
-    
-    @classmethod
-    def from_dict(cls, data: dict) -> "Message":
-        return cls(
-            id=data.get("id", str(uuid.uuid4())),
-            role=data["role"],
-            content=data["content"],
-            timestamp=data.get("timestamp", datetime.now().isoformat()),
-            image_base64=data.get("image_base64")
-        )
+    # Screenshot file in the .chat.d folder; only messages from older .chat
+    # files have one, new screenshots are stored on the annotation
+    image_path: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class Annotation:
     """An annotation on a PDF - represents a screenshot selection with its chat."""
     id: str
@@ -48,37 +80,14 @@ class Annotation:
     created_at: str = field(default_factory=lambda: datetime.now().isoformat())
     # For screenshot annotations
     bounding_box: Optional[dict] = None  # {x, y, width, height} in PDF coordinates
-    image_base64: Optional[str] = None  # Screenshot image data
+    image_path: Optional[str] = None  # Screenshot file in the .chat.d folder
     # AI-generated title for this annotation
     title: Optional[str] = None
     # Chat messages for this annotation
     messages: List[Message] = field(default_factory=list)
-    
-    def to_dict(self) -> dict:
-        return {
-            "id": self.id,
-            "page_number": self.page_number,
-            "created_at": self.created_at,
-            "bounding_box": self.bounding_box,
-            "image_base64": self.image_base64,
-            "title": self.title,
-            "messages": [m.to_dict() for m in self.messages]
-        }
-    
-    @classmethod
-    def from_dict(cls, data: dict) -> "Annotation":
-        return cls(
-            id=data["id"],
-            page_number=data["page_number"],
-            created_at=data.get("created_at", datetime.now().isoformat()),
-            bounding_box=data.get("bounding_box"),
-            image_base64=data.get("image_base64"),
-            title=data.get("title"),
-            messages=[Message.from_dict(m) for m in data.get("messages", [])]
-        )
 
 
-@dataclass
+@dataclass(slots=True)
 class Note:
     """A note on a PDF - represents a text highlight with a comment or drawing."""
     id: str
@@ -93,34 +102,9 @@ class Note:
     content: str = ""  # Text content or SVG path data
     # AI-generated title for this note
     title: Optional[str] = None
-    
-    def to_dict(self) -> dict:
-        return {
-            "id": self.id,
-            "page_number": self.page_number,
-            "created_at": self.created_at,
-            "selected_text": self.selected_text,
-            "bounding_box": self.bounding_box,
-            "content_type": self.content_type,
-            "content": self.content,
-            "title": self.title
-        }
-    
-    @classmethod
-    def from_dict(cls, data: dict) -> "Note":
-        return cls(
-            id=data["id"],
-            page_number=data["page_number"],
-            created_at=data.get("created_at", datetime.now().isoformat()),
-            selected_text=data.get("selected_text", ""),
-            bounding_box=data.get("bounding_box"),
-            content_type=data.get("content_type", "text"),
-            content=data.get("content", ""),
-            title=data.get("title")
-        )
 
 
-@dataclass
+@dataclass(slots=True)
 class ChatFile:
     """Represents the entire .chat file for a PDF."""
     pdf_path: str
@@ -129,82 +113,571 @@ class ChatFile:
     updated_at: str = field(default_factory=lambda: datetime.now().isoformat())
     annotations: Dict[str, Annotation] = field(default_factory=dict)
     notes: Dict[str, Note] = field(default_factory=dict)
+    # Sequence number of the last journal record reflected in this file
+    journal_seq: int = 0
+
+
+# msgspec encodes and decodes the dataclasses directly, without building
+# an intermediate tree of dicts in Python
+_encoder = msgspec.json.Encoder()
+_chat_file_decoder = msgspec.json.Decoder(ChatFile)
+
+
+def _apply_journal_record(chat_file: ChatFile, record: dict):
+    """Replay one journal record onto a ChatFile."""
+    op = record["op"]
+    annotation = chat_file.annotations.get(record.get("annotation_id"))
     
-    def to_dict(self) -> dict:
-        return {
-            "pdf_path": self.pdf_path,
-            "pdf_name": self.pdf_name,
-            "created_at": self.created_at,
-            "updated_at": self.updated_at,
-            "annotations": {k: v.to_dict() for k, v in self.annotations.items()},
-            "notes": {k: v.to_dict() for k, v in self.notes.items()}
-        }
-    
-    @classmethod
-    def from_dict(cls, data: dict) -> "ChatFile":
-        return cls(
-            pdf_path=data["pdf_path"],
-            pdf_name=data["pdf_name"],
-            created_at=data.get("created_at", datetime.now().isoformat()),
-            updated_at=data.get("updated_at", datetime.now().isoformat()),
-            annotations={k: Annotation.from_dict(v) for k, v in data.get("annotations", {}).items()},
-            notes={k: Note.from_dict(v) for k, v in data.get("notes", {}).items()}
-        )
+    if op == "add_annotation":
+        chat_file.annotations[record["annotation"]["id"]] = msgspec.convert(record["annotation"], Annotation)
+    elif op == "add_messages" and annotation:
+        annotation.messages.extend(msgspec.convert(record["messages"], List[Message]))
+    elif op == "set_annotation_title" and annotation:
+        annotation.title = record["title"]
+    elif op == "edit_message" and annotation:
+        for message in annotation.messages:
+            if message.id == record["message_id"]:
+                message.content = record["new_content"]
+    elif op == "delete_message" and annotation:
+        annotation.messages = [m for m in annotation.messages if m.id != record["message_id"]]
+    elif op == "delete_annotation":
+        chat_file.annotations.pop(record["annotation_id"], None)
+    elif op == "create_note":
+        chat_file.notes[record["note"]["id"]] = msgspec.convert(record["note"], Note)
+    elif op == "update_note" and record["note_id"] in chat_file.notes:
+        note = chat_file.notes[record["note_id"]]
+        for key in ("content_type", "content", "title"):
+            if record.get(key) is not None:
+                setattr(note, key, record[key])
+    elif op == "delete_note":
+        chat_file.notes.pop(record["note_id"], None)
+    
+    chat_file.updated_at = record["at"]
+
+
+def _atomic_write(path: Path, data: bytes):
+    """Write a file via a temporary file renamed over it, so a crash never
+    leaves it half-written."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            _datasync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+@dataclass(slots=True)
+class _SaveJob:
+    """An encoded save waiting to be written: journal records or a whole snapshot."""
+    records: List[dict]
+    data: bytes
+    snapshot: bool = False
+    # Screenshot file names in the .chat.d folder just before the snapshot
+    # was written, and the ones found unused after it (snapshot saves only)
+    images: Optional[set] = None
+    unused_images: Optional[set] = None
+    # Modification times of the files once written; see _get_stamp()
+    stamp: Optional[Tuple[int, int]] = None
+
+
+def _image_name(item_id: str) -> str:
+    """Get the screenshot file name for an annotation or message ID."""
+    # Only a plain file name, so an ID can't point outside the folder
+    return f"{Path(item_id).name}.png"
 
 
 class ChatStorage:
     """Manages loading and saving .chat files."""
     
     def __init__(self):
-        # Cache of loaded chat files by PDF path
+        # Cache of loaded chat files by PDF path, least recently used first
         self._cache: Dict[str, ChatFile] = {}
+        # Modification times of each cached file's snapshot and journal when
+        # last read or written, to notice changes made by someone else
+        self._stamps: Dict[str, Optional[Tuple[int, int]]] = {}
+        # Each cached file encoded as JSON for load_json_async(), until it changes
+        self._json: Dict[str, bytes] = {}
+        # PDF paths with changes that haven't been written yet
+        self._dirty: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        # Journal records not yet written, and records already in each journal
+        self._pending: Dict[str, List[dict]] = {}
+        self._journal_counts: Dict[str, int] = {}
+        # PDF paths whose snapshot still has inline images to drop
+        self._needs_compaction: set = set()
+        # Recently used screenshots by file path
+        self._images = LRUCache(maxsize=IMAGE_CACHE_SIZE)
+        # (PDF path, file name) of screenshots being written in a worker thread
+        self._writing_images: set = set()
+        # Serializes background writes; see save_async()
+        self._save_lock = asyncio.Lock()
+        self._save_tasks: set = set()
+        # .chat, .chat.log and .chat.d paths by PDF path and suffix
+        self._paths: Dict[Tuple[str, str], Path] = {}
+    
+    def _get_side_path(self, pdf_path: str, suffix: str) -> Path:
+        """Get the path of a file stored next to a PDF, e.g. its .chat file."""
+        key = (pdf_path, suffix)
+        path = self._paths.get(key)
+        if path is None:
+            path = self._paths[key] = Path(pdf_path).with_suffix(suffix)
+        return path
     
     def _get_chat_path(self, pdf_path: str) -> Path:
         """Get the .chat file path for a PDF."""
-        pdf_path = Path(pdf_path)
-        return pdf_path.with_suffix(".chat")
+        return self._get_side_path(pdf_path, ".chat")
     
-    def load(self, pdf_path: str) -> Optional[ChatFile]:
-        """Load a .chat file for a PDF. Returns None if doesn't exist."""
-        chat_path = self._get_chat_path(pdf_path)
+    def _get_journal_path(self, pdf_path: str) -> Path:
+        """Get the .chat.log journal path for a PDF."""
+        return self._get_side_path(pdf_path, ".chat.log")
+    
+    def _get_image_dir(self, pdf_path: str) -> Path:
+        """Get the .chat.d folder holding a PDF's screenshots."""
+        return self._get_side_path(pdf_path, ".chat.d")
+    
+    def _write_image(self, pdf_path: str, item_id: str, image: bytes) -> str:
+        """Store a screenshot as a PNG file. Returns its file name."""
+        name = _image_name(item_id)
+        self._write_image_file(pdf_path, name, image)
+        self._images[str(self._get_image_dir(pdf_path) / name)] = image
+        return name
+    
+    def _write_image_file(self, pdf_path: str, name: str, image: bytes):
+        """Write a screenshot's PNG file. Touches no ChatStorage state."""
+        image_dir = self._get_image_dir(pdf_path)
+        image_dir.mkdir(exist_ok=True)
+        _atomic_write(image_dir / name, image)
+    
+    def get_image_path(self, pdf_path: StrPath, name: str) -> Optional[Path]:
+        """Get the file holding a stored screenshot. Returns None if it doesn't exist."""
+        pdf_path = os.fspath(pdf_path)
+        if Path(name).name != name:
+            return None
+        path = self._get_image_dir(pdf_path) / name
+        return path if path.is_file() else None
+    
+    def get_image_bytes(self, pdf_path: StrPath, name: str) -> Optional[bytes]:
+        """Get a stored screenshot's PNG data. Returns None if it doesn't exist."""
+        pdf_path = os.fspath(pdf_path)
+        path = self.get_image_path(pdf_path, name)
+        if path is None:
+            return None
         
+        key = str(path)
+        if key not in self._images:
+            self._images[key] = path.read_bytes()
+        return self._images[key]
+    
+    async def get_image_bytes_async(self, pdf_path: StrPath, name: str) -> Optional[bytes]:
+        """Like get_image_bytes(), but reads the file in a worker thread."""
+        pdf_path = os.fspath(pdf_path)
+        if Path(name).name != name:
+            return None
+        
+        key = str(self._get_image_dir(pdf_path) / name)
+        if key not in self._images:
+            try:
+                image = await anyio.to_thread.run_sync(Path(key).read_bytes)
+            except FileNotFoundError:
+                return None
+            self._images[key] = image
+        return self._images[key]
+    
+    def _migrate_inline_images(self, pdf_path: str, data: dict) -> bool:
+        """Move base64 images from an older .chat file's data into the .chat.d folder.
+        
+        Returns True if anything was moved.
+        """
+        migrated = False
+        for annotation in data.get("annotations", {}).values():
+            image = annotation.pop("image_base64", None)
+            if image:
+                annotation["image_path"] = self._write_image(pdf_path, annotation["id"], binascii.a2b_base64(image))
+                migrated = True
+            for message in annotation.get("messages", []):
+                image = message.pop("image_base64", None)
+                if image:
+                    message["image_path"] = self._write_image(pdf_path, message["id"], binascii.a2b_base64(image))
+                    migrated = True
+        return migrated
+    
+    def _list_images(self, pdf_path: str) -> set:
+        """Get the file names of the screenshots stored for a PDF."""
+        image_dir = self._get_image_dir(pdf_path)
+        if not image_dir.is_dir():
+            return set()
+        return {path.name for path in image_dir.glob("*.png")}
+    
+    def _find_unused_images(self, pdf_path: str, images: set) -> set:
+        """Get the screenshots in `images` that the chat file doesn't refer to."""
+        chat_file = self._cache.get(pdf_path)
+        if chat_file is None:
+            return set()
+        
+        # Screenshots still being written have no annotation yet
+        unused = {name for name in images if (pdf_path, name) not in self._writing_images}
+        for annotation in chat_file.annotations.values():
+            unused.discard(annotation.image_path)
+            unused.difference_update(m.image_path for m in annotation.messages)
+        return unused
+    
+    def _remove_images(self, pdf_path: str, names: set):
+        """Delete stored screenshots by file name."""
+        image_dir = self._get_image_dir(pdf_path)
+        for name in names:
+            (image_dir / name).unlink(missing_ok=True)
+    
+    def load(self, pdf_path: StrPath) -> Optional[ChatFile]:
+        """Load a .chat file for a PDF. Returns None if doesn't exist.
+        
+        A cached chat file is returned as is unless its files have been
+        changed on disk since, in which case they are read again.
+        """
+        pdf_path = os.fspath(pdf_path)
         if pdf_path in self._cache:
-            return self._cache[pdf_path]
+            if self._is_current(pdf_path):
+                return self._use(pdf_path)
+            self._forget(pdf_path)
         
-        if not chat_path.exists():
+        try:
+            return self._parse(pdf_path, *self._read_files(pdf_path))
+        except Exception:
+            logger.exception("Error loading chat file for %s", pdf_path)
             return None
+    
+    async def load_async(self, pdf_path: StrPath) -> Optional[ChatFile]:
+        """Like load(), but reads the files in a worker thread."""
+        pdf_path = os.fspath(pdf_path)
+        if pdf_path in self._cache:
+            if self._is_current(pdf_path):
+                return self._use(pdf_path)
+            self._forget(pdf_path)
         
         try:
-            with open(chat_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            chat_file = ChatFile.from_dict(data)
-            self._cache[pdf_path] = chat_file
-            return chat_file
-        except Exception as e:
-            print(f"Error loading chat file: {e}")
+            files = await anyio.to_thread.run_sync(self._read_files, pdf_path)
+            # Another request may have loaded it in the meantime
+            if pdf_path in self._cache:
+                return self._use(pdf_path)
+            return self._parse(pdf_path, *files)
+        except Exception:
+            logger.exception("Error loading chat file for %s", pdf_path)
             return None
     
-    def save(self, pdf_path: str) -> bool:
-        """Save the chat file for a PDF."""
-        if pdf_path not in self._cache:
-            return False
+    async def load_json_async(self, pdf_path: StrPath) -> Optional[bytes]:
+        """Like load_async(), but returns the chat file encoded as JSON.
         
-        chat_file = self._cache[pdf_path]
-        chat_file.updated_at = datetime.now().isoformat()
-        chat_path = self._get_chat_path(pdf_path)
+        The encoding is kept until the chat file changes, so loading an
+        unchanged file again doesn't re-encode every message.
+        """
+        pdf_path = os.fspath(pdf_path)
+        chat_file = await self.load_async(pdf_path)
+        if chat_file is None:
+            return None
         
+        data = self._json.get(pdf_path)
+        if data is None:
+            data = self._json[pdf_path] = _encoder.encode(chat_file)
+        return data
+    
+    def _read_files(self, pdf_path: str) -> Tuple[Optional[bytes], Optional[bytes], Optional[Tuple[int, int]]]:
+        """Read a PDF's snapshot and journal, either of which may be missing,
+        along with their modification times."""
+        # Taken first, so a change made while reading is noticed next time
+        stamp = self._get_stamp(pdf_path)
+        try:
+            snapshot = self._get_chat_path(pdf_path).read_bytes()
+        except FileNotFoundError:
+            return None, None, None
+        try:
+            journal = self._get_journal_path(pdf_path).read_bytes()
+        except FileNotFoundError:
+            journal = None
+        return snapshot, journal, stamp
+    
+    def _get_stamp(self, pdf_path: str) -> Optional[Tuple[int, int]]:
+        """Get the modification times of a PDF's snapshot and journal (0 if
+        there is none). Returns None if it has no snapshot."""
+        try:
+            snapshot = self._get_chat_path(pdf_path).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
         try:
-            with open(chat_path, 'w', encoding='utf-8') as f:
-                json.dump(chat_file.to_dict(), f, indent=2, ensure_ascii=False)
+            journal = self._get_journal_path(pdf_path).stat().st_mtime_ns
+        except FileNotFoundError:
+            journal = 0
+        return snapshot, journal
+    
+    def _is_current(self, pdf_path: str) -> bool:
+        """Check a cached chat file still matches its files on disk.
+        
+        Unsaved changes, or ones being written, win over changes made to the
+        files by someone else.
+        """
+        if pdf_path in self._dirty or self._save_lock.locked():
             return True
+        return self._stamps.get(pdf_path) == self._get_stamp(pdf_path)
+    
+    def _use(self, pdf_path: str) -> ChatFile:
+        """Get a cached chat file, marking it as the most recently used."""
+        chat_file = self._cache[pdf_path] = self._cache.pop(pdf_path)
+        return chat_file
+    
+    def _forget(self, pdf_path: str):
+        """Drop a chat file without unsaved changes from the cache."""
+        self._cache.pop(pdf_path, None)
+        self._stamps.pop(pdf_path, None)
+        self._json.pop(pdf_path, None)
+        self._journal_counts.pop(pdf_path, None)
+    
+    def _trim_cache(self):
+        """Drop the least recently used chat files beyond CHAT_CACHE_SIZE.
+        
+        The most recently used one is always kept, as the caller may be about
+        to change it. Must not run while a write is in progress, as the file
+        being written no longer counts as dirty.
+        """
+        excess = len(self._cache) - CHAT_CACHE_SIZE
+        for path in list(self._cache)[:-1]:
+            if excess <= 0:
+                break
+            if path not in self._dirty and path not in self._pending:
+                self._forget(path)
+                excess -= 1
+    
+    def _parse(
+        self,
+        pdf_path: str,
+        snapshot: Optional[bytes],
+        journal: Optional[bytes],
+        stamp: Optional[Tuple[int, int]]
+    ) -> Optional[ChatFile]:
+        """Decode a snapshot, replay its journal and cache the result."""
+        if snapshot is None:
+            return None
+        
+        migrated = False
+        if b'"image_base64"' in snapshot:
+            # An older file with inline images: move them out first
+            data = msgspec.json.decode(snapshot)
+            migrated = self._migrate_inline_images(pdf_path, data)
+            chat_file = msgspec.convert(data, ChatFile)
+        else:
+            chat_file = _chat_file_decoder.decode(snapshot)
+        self._journal_counts[pdf_path] = self._replay_journal(pdf_path, chat_file, journal) if journal else 0
+        self._cache[pdf_path] = chat_file
+        self._stamps[pdf_path] = stamp
+        self._json.pop(pdf_path, None)
+        if not self._save_lock.locked():
+            self._trim_cache()
+        if migrated:
+            # Rewrite the snapshot without the inline images
+            self._needs_compaction.add(pdf_path)
+            self.mark_dirty(pdf_path)
+        return chat_file
+    
+    def _replay_journal(self, pdf_path: str, chat_file: ChatFile, journal: bytes) -> int:
+        """Apply journal records newer than the snapshot. Returns how many were applied."""
+        count = 0
+        offset = 0
+        for line in journal.splitlines(keepends=True):
+            try:
+                record = msgspec.json.decode(line)
+            except msgspec.DecodeError:
+                # A record torn by a crash mid-write. Cut it off so records
+                # appended from now on aren't stuck behind it.
+                os.truncate(self._get_journal_path(pdf_path), offset)
+                break
+            offset += len(line)
+            # Skip records already folded into the snapshot
+            if record["seq"] <= chat_file.journal_seq:
+                continue
+            _apply_journal_record(chat_file, record)
+            chat_file.journal_seq = record["seq"]
+            count += 1
+        
+        return count
+    
+    def save(self, pdf_path: StrPath, compact: bool = False) -> bool:
+        """Save the chat file for a PDF.
+        
+        Pending changes are appended to the journal; the snapshot is rewritten
+        instead when it doesn't exist yet, the journal has grown long, or
+        `compact` is set.
+        """
+        pdf_path = os.fspath(pdf_path)
+        job = self._start_save(pdf_path, compact)
+        if job is None:
+            return False
+        
+        try:
+            self._write(pdf_path, job)
         except Exception as e:
-            print(f"Error saving chat file: {e}")
+            self._save_failed(pdf_path, job, e)
             return False
+        self._save_done(pdf_path, job)
+        if job.unused_images:
+            self._remove_images(pdf_path, job.unused_images)
+        return True
+    
+    async def save_async(self, pdf_path: StrPath, compact: bool = False) -> bool:
+        """Like save(), but writes the files in a worker thread.
+        
+        The chat data is encoded on the calling thread, so requests can keep
+        changing it while the write is in progress.
+        """
+        pdf_path = os.fspath(pdf_path)
+        # One write at a time, so journal records land in order
+        async with self._save_lock:
+            job = self._start_save(pdf_path, compact)
+            if job is None:
+                return False
+            
+            try:
+                await anyio.to_thread.run_sync(self._write, pdf_path, job)
+            except Exception as e:
+                self._save_failed(pdf_path, job, e)
+                return False
+            self._save_done(pdf_path, job)
+            if job.unused_images:
+                await anyio.to_thread.run_sync(self._remove_images, pdf_path, job.unused_images)
+            return True
+    
+    def _start_save(self, pdf_path: str, compact: bool) -> Optional[_SaveJob]:
+        """Take a PDF's pending changes and encode what has to be written."""
+        if pdf_path not in self._cache:
+            return None
+        
+        self._dirty.discard(pdf_path)
+        chat_file = self._cache[pdf_path]
+        records = self._pending.pop(pdf_path, [])
+        journal_count = self._journal_counts.get(pdf_path, 0)
+        
+        if (
+            records
+            and not compact
+            and pdf_path not in self._needs_compaction
+            and self._get_chat_path(pdf_path).exists()
+            and journal_count + len(records) < JOURNAL_COMPACT_RECORDS
+        ):
+            data = b"".join(_encoder.encode(record) + b"\n" for record in records)
+            return _SaveJob(records=records, data=data)
+        
+        chat_file.updated_at = datetime.now().isoformat()
+        self._json.pop(pdf_path, None)
+        data = msgspec.json.format(_encoder.encode(chat_file), indent=2)
+        return _SaveJob(records=records, data=data, snapshot=True)
+    
+    def _write(self, pdf_path: str, job: _SaveJob):
+        """Write an encoded save to disk. Touches no ChatStorage state."""
+        if not job.snapshot:
+            with open(self._get_journal_path(pdf_path), 'ab') as f:
+                f.write(job.data)
+                f.flush()
+                _datasync(f.fileno())
+        else:
+            # Listed before writing, so screenshots added during the write
+            # are never considered for removal; see _save_done()
+            job.images = self._list_images(pdf_path)
+            _atomic_write(self._get_chat_path(pdf_path), job.data)
+            
+            # The snapshot records journal_seq, so a journal left behind by a
+            # crash here is skipped on the next load
+            self._get_journal_path(pdf_path).unlink(missing_ok=True)
+        job.stamp = self._get_stamp(pdf_path)
+    
+    def _save_done(self, pdf_path: str, job: _SaveJob):
+        """Update the journal bookkeeping after a successful save."""
+        if job.snapshot:
+            self._journal_counts[pdf_path] = 0
+            self._needs_compaction.discard(pdf_path)
+            # Checked against the chat file as it is now, not as it was
+            # encoded, as annotations may have been added meanwhile
+            job.unused_images = self._find_unused_images(pdf_path, job.images)
+        else:
+            self._journal_counts[pdf_path] = self._journal_counts.get(pdf_path, 0) + len(job.records)
+        self._stamps[pdf_path] = job.stamp
+        self._trim_cache()
+    
+    def _save_failed(self, pdf_path: str, job: _SaveJob, error: Exception):
+        """Put a failed save's changes back so the next save retries them."""
+        logger.error("Error saving chat file for %s: %s", pdf_path, error)
+        self._pending[pdf_path] = job.records + self._pending.get(pdf_path, [])
+        self._dirty.add(pdf_path)
     
-    def get_or_create_chat_file(self, pdf_path: str) -> ChatFile:
+    def _record(self, pdf_path: str, record: dict):
+        """Queue a journal record for a change and schedule a save."""
+        chat_file = self._cache[pdf_path]
+        self._json.pop(pdf_path, None)
+        chat_file.journal_seq += 1
+        chat_file.updated_at = datetime.now().isoformat()
+        record["seq"] = chat_file.journal_seq
+        record["at"] = chat_file.updated_at
+        self._pending.setdefault(pdf_path, []).append(record)
+        self.mark_dirty(pdf_path)
+    
+    def mark_dirty(self, pdf_path: StrPath):
+        """Schedule the chat file for a PDF to be saved shortly."""
+        pdf_path = os.fspath(pdf_path)
+        self._dirty.add(pdf_path)
+        
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running under the server's event loop; save right away
+            self.save(pdf_path)
+            return
+        
+        if len(self._pending.get(pdf_path, ())) >= SAVE_MAX_PENDING_RECORDS:
+            # Don't let a long burst of edits hold back an unbounded backlog
+            task = loop.create_task(self.flush(pdf_path))
+            self._save_tasks.add(task)
+            task.add_done_callback(self._save_tasks.discard)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+    
+    async def _flush_later(self):
+        """Save all dirty chat files once the debounce delay has passed."""
+        await asyncio.sleep(SAVE_DEBOUNCE_DELAY)
+        await self.flush()
+    
+    async def flush(self, pdf_path: Optional[StrPath] = None):
+        """Save pending changes now, for one PDF or for all of them.
+        
+        Changes made while a save is being written are saved too, once it's
+        done, and a debounced save already being written is waited for. A
+        file whose save fails is left for the next change to retry.
+        """
+        only = os.fspath(pdf_path) if pdf_path is not None else None
+        failed = set()
+        while True:
+            # A save in progress has already taken its file off _dirty
+            async with self._save_lock:
+                pass
+            paths = [only] if only is not None else list(self._dirty)
+            paths = [path for path in paths if path in self._dirty and path not in failed]
+            if not paths:
+                return
+            for path in paths:
+                if not await self.save_async(path):
+                    failed.add(path)
+    
+    async def close(self):
+        """Save pending changes and fold every journal into its snapshot."""
+        async with self._save_lock:
+            pass
+        for path in list(self._cache):
+            if path in self._dirty or self._journal_counts.get(path):
+                await self.save_async(path, compact=True)
+    
+    def get_or_create_chat_file(self, pdf_path: StrPath) -> ChatFile:
         """Get or create a ChatFile for a PDF."""
+        pdf_path = os.fspath(pdf_path)
         if pdf_path in self._cache:
-            return self._cache[pdf_path]
+            return self._use(pdf_path)
         
         chat_file = self.load(pdf_path)
         if chat_file is None:
@@ -218,15 +691,63 @@ class ChatStorage:
     
     def get_or_create_annotation(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str,
         page_number: int,
         bounding_box: Optional[dict] = None,
-        image_base64: Optional[str] = None
+        image: Optional[bytes] = None
     ) -> Annotation:
         """Get or create an annotation."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
+        if annotation_id in chat_file.annotations:
+            return chat_file.annotations[annotation_id]
+        
+        image_path = self._write_image(pdf_path, annotation_id, image) if image else None
+        return self._add_annotation(pdf_path, annotation_id, page_number, bounding_box, image_path)
+    
+    async def get_or_create_annotation_async(
+        self,
+        pdf_path: StrPath,
+        annotation_id: str,
+        page_number: int,
+        bounding_box: Optional[dict] = None,
+        image: Optional[bytes] = None
+    ) -> Annotation:
+        """Like get_or_create_annotation(), but reads the chat file and writes
+        the screenshot in a worker thread."""
+        pdf_path = os.fspath(pdf_path)
+        await self.load_async(pdf_path)
+        annotation = self.get_annotation(pdf_path, annotation_id)
+        if annotation is not None:
+            return annotation
+        
+        if not image:
+            return self._add_annotation(pdf_path, annotation_id, page_number, bounding_box, None)
+        
+        name = _image_name(annotation_id)
+        key = (pdf_path, name)
+        # Keeps a snapshot save from deleting the file before the annotation
+        # referring to it exists
+        self._writing_images.add(key)
+        try:
+            await anyio.to_thread.run_sync(self._write_image_file, pdf_path, name, image)
+            self._images[str(self._get_image_dir(pdf_path) / name)] = image
+            return self._add_annotation(pdf_path, annotation_id, page_number, bounding_box, name)
+        finally:
+            self._writing_images.discard(key)
+    
+    def _add_annotation(
+        self,
+        pdf_path: str,
+        annotation_id: str,
+        page_number: int,
+        bounding_box: Optional[dict],
+        image_path: Optional[str]
+    ) -> Annotation:
+        """Add a new annotation, unless one with this ID was added meanwhile."""
+        chat_file = self.get_or_create_chat_file(pdf_path)
         if annotation_id in chat_file.annotations:
             return chat_file.annotations[annotation_id]
         
@@ -234,49 +755,69 @@ class ChatStorage:
             id=annotation_id,
             page_number=page_number,
             bounding_box=bounding_box,
-            image_base64=image_base64
+            image_path=image_path
         )
         chat_file.annotations[annotation_id] = annotation
+        self._record(pdf_path, {"op": "add_annotation", "annotation": msgspec.to_builtins(annotation)})
         return annotation
     
+    def get_annotation(
+        self,
+        pdf_path: StrPath,
+        annotation_id: str
+    ) -> Optional[Annotation]:
+        """Get an annotation. Returns None if it doesn't exist."""
+        pdf_path = os.fspath(pdf_path)
+        chat_file = self.get_or_create_chat_file(pdf_path)
+        return chat_file.annotations.get(annotation_id)
+    
     def add_messages(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str,
         messages: List[Message]
     ) -> bool:
         """Add messages to an annotation."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if annotation_id not in chat_file.annotations:
             return False
         
         chat_file.annotations[annotation_id].messages.extend(messages)
+        self._record(pdf_path, {
+            "op": "add_messages",
+            "annotation_id": annotation_id,
+            "messages": msgspec.to_builtins(messages)
+        })
         return True
     
     def set_annotation_title(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str,
         title: str
     ) -> bool:
         """Set the title of an annotation."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if annotation_id not in chat_file.annotations:
             return False
         
         chat_file.annotations[annotation_id].title = title
+        self._record(pdf_path, {"op": "set_annotation_title", "annotation_id": annotation_id, "title": title})
         return True
     
     def edit_message(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str,
         message_id: str,
         new_content: str
     ) -> bool:
         """Edit a message's content."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if annotation_id not in chat_file.annotations:
@@ -286,17 +827,24 @@ class ChatStorage:
         for message in annotation.messages:
             if message.id == message_id:
                 message.content = new_content
+                self._record(pdf_path, {
+                    "op": "edit_message",
+                    "annotation_id": annotation_id,
+                    "message_id": message_id,
+                    "new_content": new_content
+                })
                 return True
         
         return False
     
     def delete_message(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str,
         message_id: str
     ) -> bool:
         """Delete a message from an annotation."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if annotation_id not in chat_file.annotations:
@@ -306,20 +854,26 @@ class ChatStorage:
         original_len = len(annotation.messages)
         annotation.messages = [m for m in annotation.messages if m.id != message_id]
         
-        return len(annotation.messages) < original_len
+        if len(annotation.messages) == original_len:
+            return False
+        
+        self._record(pdf_path, {"op": "delete_message", "annotation_id": annotation_id, "message_id": message_id})
+        return True
     
     def delete_annotation(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         annotation_id: str
     ) -> bool:
         """Delete an entire annotation."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if annotation_id not in chat_file.annotations:
             return False
         
         del chat_file.annotations[annotation_id]
+        self._record(pdf_path, {"op": "delete_annotation", "annotation_id": annotation_id})
         return True
 
     # ============================================
@@ -328,7 +882,7 @@ class ChatStorage:
 
     def create_note(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         note_id: str,
         page_number: int,
         selected_text: str,
@@ -337,6 +891,7 @@ class ChatStorage:
         content: str = ""
     ) -> Note:
         """Create a new note."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         note = Note(
@@ -348,41 +903,52 @@ class ChatStorage:
             content=content
         )
         chat_file.notes[note_id] = note
+        self._record(pdf_path, {"op": "create_note", "note": msgspec.to_builtins(note)})
         return note
 
     def update_note(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         note_id: str,
         content_type: Optional[str] = None,
         content: Optional[str] = None,
         title: Optional[str] = None
-    ) -> bool:
-        """Update a note's content."""
+    ) -> Optional[Note]:
+        """Update a note's content. Returns the note, or None if it doesn't exist."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
-        if note_id not in chat_file.notes:
-            return False
+        note = chat_file.notes.get(note_id)
+        if note is None:
+            return None
         
-        note = chat_file.notes[note_id]
         if content_type is not None:
             note.content_type = content_type
         if content is not None:
             note.content = content
         if title is not None:
             note.title = title
-        return True
+        self._record(pdf_path, {
+            "op": "update_note",
+            "note_id": note_id,
+            "content_type": content_type,
+            "content": content,
+            "title": title
+        })
+        return note
 
     def delete_note(
         self,
-        pdf_path: str,
+        pdf_path: StrPath,
         note_id: str
     ) -> bool:
         """Delete a note."""
+        pdf_path = os.fspath(pdf_path)
         chat_file = self.get_or_create_chat_file(pdf_path)
         
         if note_id not in chat_file.notes:
             return False
         
         del chat_file.notes[note_id]
+        self._record(pdf_path, {"op": "delete_note", "note_id": note_id})
         return True
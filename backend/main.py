@@ -1,13 +1,26 @@
 """
 Margo Backend - AI-powered PDF annotation service
 """
-import base64
-from typing import Optional, List
+import io
+import os
+import json
+import queue
+import asyncio
+import logging
+import threading
+from typing import Optional, List, Awaitable
 from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 
-from fastapi import FastAPI, HTTPException, Form
+import anyio
+import msgspec
+from cachetools import LRUCache
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing_extensions import TypedDict
 from dotenv import load_dotenv
 
 from ai_service import AIService
@@ -15,48 +28,139 @@ from chat_storage import ChatStorage, Message
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Worker threads for blocking work: page rendering, chat file and
+# screenshot I/O, and file responses (anyio's default is 40)
+THREADPOOL_SIZE = 64
+
+# Open PDF documents and rendered pages kept for /extract-page-image
+PAGE_DOCUMENT_CACHE_SIZE = 8
+PAGE_IMAGE_CACHE_SIZE = 32
+# Page image formats by name. Previews don't need lossless PNG, and WebP is
+# several times smaller and quicker to encode.
+PAGE_IMAGE_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+PAGE_IMAGE_QUALITY = 85  # for WebP and JPEG
+TITLE_WAIT_TIMEOUT = 30.0  # Seconds /annotation-title waits for a pending title
+# Seconds the renderer may reuse a CORS preflight for (Chromium caps it at 2 hours)
+CORS_MAX_AGE = 7200
+
+# Context sent to the AI along with a screenshot
+_IMAGE_CONTEXT = "An image of the selected section is attached."
+
 # Initialize services
 ai_service: Optional[AIService] = None
 chat_storage = ChatStorage()
 
 
+def _start_logging() -> QueueListener:
+    """Route log records through a queue to a background thread, so writing
+    them out never blocks the event loop."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    
+    root = logging.getLogger()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # httpx logs every Gemini API call at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    listener.start()
+    return listener
+
+
+def _stop_logging(listener: QueueListener):
+    """Undo _start_logging(), writing out any records still queued."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            root.removeHandler(handler)
+    listener.stop()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Initialize services on startup."""
     global ai_service
+    log_listener = _start_logging()
     ai_service = AIService()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    app.state.title_tasks = {}
     yield
+    # Let titles still being generated land before the final save, but don't
+    # hang shutdown on a slow (e.g. Batch Mode) one
+    if app.state.title_tasks:
+        await asyncio.wait(list(app.state.title_tasks.values()), timeout=TITLE_WAIT_TIMEOUT)
+    await ai_service.aclose()
+    # Write out any changes still waiting for the debounced save
+    await chat_storage.close()
+    # Close the PDFs kept open for page rendering
+    _page_documents.clear()
+    _stop_logging(log_listener)
+
+
+class MsgspecJSONResponse(JSONResponse):
+    """JSON response encoded with msgspec, which is much faster than the
+    standard json module.
+    
+    Values returned from an endpoint still go through FastAPI's
+    jsonable_encoder first. Return an instance directly to skip that and
+    have msgspec encode the storage dataclasses itself.
+    """
+    
+    def render(self, content) -> bytes:
+        return msgspec.json.encode(content)
 
 
 app = FastAPI(
     title="Margo Backend",
     description="AI-powered PDF annotation backend",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=MsgspecJSONResponse
 )
 
-# Configure CORS for Electron app
+# Configure CORS for Electron app. The renderer is loaded from a file://
+# URL, which browsers send as the "null" origin. It sends no cookies, so
+# credentials stay off.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=["null"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type"],
+    max_age=CORS_MAX_AGE,
 )
 
 
 # Request/Response Models
+
+# Typed dicts rather than plain `dict` fields keep validation in
+# pydantic-core, and still hand the storage and AI layers plain dicts
+class BoundingBox(TypedDict):
+    """A selection in PDF coordinates."""
+    x: float
+    y: float
+    width: float
+    height: float
+
+
+class HistoryMessage(TypedDict):
+    """An earlier message in an annotation's chat."""
+    role: str
+    content: str
+
+
 class AskRequest(BaseModel):
     pdf_path: str
     annotation_id: str
     question: str
-    # For screenshot-based questions
-    image_base64: Optional[str] = None
-    bounding_box: Optional[dict] = None
+    # For screenshot-based questions (the image itself is a separate upload)
+    bounding_box: Optional[BoundingBox] = None
     # Page info
     page_number: int
     # Previous messages in this annotation's chat
-    chat_history: Optional[List[dict]] = None
+    chat_history: Optional[List[HistoryMessage]] = None
 
 
 class EditMessageRequest(BaseModel):
@@ -97,7 +201,7 @@ class CreateNoteRequest(BaseModel):
     note_id: str
     page_number: int
     selected_text: str
-    bounding_box: Optional[dict] = None
+    bounding_box: Optional[BoundingBox] = None
     content_type: str = "text"
     content: str = ""
 
@@ -126,7 +230,7 @@ async def get_providers():
     """Get list of available AI providers and their models."""
     if not ai_service:
         return {"providers": []}
-    return {"providers": ai_service.get_available_providers()}
+    return {"providers": await ai_service.get_available_providers()}
 
 
 @app.get("/current-model")
@@ -147,65 +251,80 @@ async def set_model(request: SetModelRequest):
     return {"status": "ok", "provider": request.provider, "model": request.model_id}
 
 
+def _ndjson(event: dict) -> bytes:
+    """Encode one event of a newline-delimited JSON stream."""
+    return (json.dumps(event) + "\n").encode("utf-8")
+
+
 @app.post("/ask")
-async def ask_question(request: AskRequest):
-    """Ask a question about a PDF section (screenshot)."""
+async def ask_question(
+    request: str = Form(...),
+    image: Optional[UploadFile] = File(None)
+):
+    """Ask a question about a PDF section (screenshot).
+    
+    Takes multipart form data: `request` is an AskRequest as JSON, and
+    `image` the PNG screenshot, sent as raw bytes rather than base64 in the
+    JSON body. Follow-up questions can leave the image out.
+    
+    The answer is streamed back as newline-delimited JSON: a {"type": "chunk"}
+    event per piece of text, then a single {"type": "done"} event with the
+    stored message IDs and title, or {"type": "error"} if something failed.
+    """
     if not ai_service or not ai_service.is_configured():
         raise HTTPException(status_code=503, detail="AI service not configured. Please set API keys.")
     
     try:
-        # Build context for the AI
-        context_parts = []
-        
-        if request.image_base64:
-            context_parts.append("An image of the selected section is attached.")
-        
-        # Get AI response
-        response = await ai_service.ask(
+        ask_request = AskRequest.model_validate_json(request)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    image_bytes = await image.read() if image else None
+    
+    return StreamingResponse(_ask_events(ask_request, image_bytes), media_type="application/x-ndjson")
+
+
+async def _ask_events(request: AskRequest, new_image: Optional[bytes]):
+    """Stream the answer for /ask, then store the exchange."""
+    try:
+        # Read the chat file in a worker thread if it isn't cached yet
+        await chat_storage.load_async(request.pdf_path)
+        stored = chat_storage.get_annotation(request.pdf_path, request.annotation_id)
+        
+        # Follow-up questions don't resend the screenshot; use the stored one
+        image = new_image
+        if not image and stored and stored.image_path:
+            image = await chat_storage.get_image_bytes_async(request.pdf_path, stored.image_path)
+        
+        # Stream the AI response. New annotations (first message) also get a
+        # title, generated while the rest of the answer streams in.
+        needs_title = not request.chat_history and not (stored and stored.title)
+        answer, title = ai_service.ask_and_title(
             question=request.question,
-            image_base64=request.image_base64,
-            context="\n\n".join(context_parts) if context_parts else None,
-            chat_history=request.chat_history
+            image=image,
+            context=_IMAGE_CONTEXT if image else None,
+            chat_history=request.chat_history,
+            annotation_id=request.annotation_id,
+            with_title=needs_title
         )
+        response_parts = []
+        async for text in answer:
+            response_parts.append(text)
+            yield _ndjson({"type": "chunk", "text": text})
+        response = "".join(response_parts)
         
         # Create/update annotation in storage
-        annotation = chat_storage.get_or_create_annotation(
+        await chat_storage.get_or_create_annotation_async(
             pdf_path=request.pdf_path,
             annotation_id=request.annotation_id,
             page_number=request.page_number,
             bounding_box=request.bounding_box,
-            image_base64=request.image_base64
+            image=new_image
         )
         
-        # Generate title for new annotations (first message)
-        generated_title = None
-        if not annotation.title and not request.chat_history:
-            try:
-                print(f"Generating title for annotation {request.annotation_id}...")
-                generated_title = await ai_service.generate_title(
-                    question=request.question,
-                    answer=response,
-                    image_base64=request.image_base64
-                )
-                print(f"Generated title: {generated_title}")
-                if generated_title:
-                    chat_storage.set_annotation_title(
-                        pdf_path=request.pdf_path,
-                        annotation_id=request.annotation_id,
-                        title=generated_title
-                    )
-                    print(f"Title saved successfully")
-            except Exception as e:
-                print(f"Error generating title: {e}")
-                import traceback
-                traceback.print_exc()
-                # Not critical, continue without title
-        
-        # Add messages to the annotation
+        # Add messages to the annotation (the screenshot is stored on the annotation)
         user_message = Message(
             role="user",
-            content=request.question,
-            image_base64=request.image_base64 if request.image_base64 else None
+            content=request.question
         )
         assistant_message = Message(
             role="assistant",
@@ -218,19 +337,107 @@ async def ask_question(request: AskRequest):
             messages=[user_message, assistant_message]
         )
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
-        
-        return {
+        # Don't hold the answer back for a title that's still generating;
+        # the frontend fetches it from /annotation-title instead
+        generated_title = None
+        title_pending = False
+        if title.done():
+            generated_title = title.result()
+            _store_title(request.pdf_path, request.annotation_id, generated_title)
+        else:
+            _start_title_task(
+                ("annotation", request.pdf_path, request.annotation_id),
+                _store_title_when_ready(request.pdf_path, request.annotation_id, title)
+            )
+            title_pending = True
+        
+        yield _ndjson({
+            "type": "done",
             "response": response,
             "annotation_id": request.annotation_id,
             "user_message_id": user_message.id,
             "assistant_message_id": assistant_message.id,
-            "title": generated_title
-        }
+            "title": generated_title,
+            "title_pending": title_pending
+        })
     
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        logger.exception("Error answering question for annotation %s", request.annotation_id)
+        yield _ndjson({"type": "error", "detail": str(e)})
+
+
+def _store_title(pdf_path: str, annotation_id: str, title: Optional[str]):
+    """Store a generated annotation title, if there is one."""
+    if title:
+        logger.info("Generated title for annotation %s: %s", annotation_id, title)
+        chat_storage.set_annotation_title(
+            pdf_path=pdf_path,
+            annotation_id=annotation_id,
+            title=title
+        )
+
+
+async def _store_title_when_ready(pdf_path: str, annotation_id: str, title: "asyncio.Future[Optional[str]]"):
+    """Store an annotation's title once it's generated."""
+    _store_title(pdf_path, annotation_id, await title)
+
+
+async def _generate_note_title(pdf_path: str, note_id: str, selected_text: str, content: str):
+    """Generate a title for a note and store it."""
+    title = await ai_service.generate_note_title(selected_text=selected_text, note_content=content)
+    if title:
+        logger.info("Generated title for note %s: %s", note_id, title)
+        chat_storage.update_note(pdf_path=pdf_path, note_id=note_id, title=title)
+
+
+def _start_title_task(key: tuple, job: Awaitable[None]):
+    """Run a title job in the background.
+    
+    The task is kept in app.state.title_tasks under `key`, ("annotation" or
+    "note", PDF path, ID), for the title endpoints to wait on.
+    """
+    async def run():
+        try:
+            await job
+        except Exception:
+            logger.exception("Error generating title for %s %s", key[0], key[2])
+    
+    task = asyncio.create_task(run())
+    app.state.title_tasks[key] = task
+    task.add_done_callback(lambda _: app.state.title_tasks.pop(key, None))
+
+
+async def _wait_for_title(key: tuple) -> bool:
+    """Wait a while for a title that's being generated. Returns True if it still is."""
+    task = app.state.title_tasks.get(key)
+    if task is None:
+        return False
+    # shield() so a client giving up doesn't cancel the title itself
+    try:
+        await asyncio.wait_for(asyncio.shield(task), TITLE_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        pass
+    return not task.done()
+
+
+@app.get("/annotation-title")
+async def get_annotation_title(pdf_path: str, annotation_id: str):
+    """Get an annotation's title, waiting for it if it's still being generated."""
+    pending = await _wait_for_title(("annotation", pdf_path, annotation_id))
+    annotation = chat_storage.get_annotation(pdf_path, annotation_id)
+    if annotation is None:
+        raise HTTPException(status_code=404, detail="Annotation not found")
+    return {"title": annotation.title, "pending": pending}
+
+
+@app.get("/note-title")
+async def get_note_title(pdf_path: str, note_id: str):
+    """Get a note's title, waiting for it if it's still being generated."""
+    pending = await _wait_for_title(("note", pdf_path, note_id))
+    note = chat_storage.get_or_create_chat_file(pdf_path).notes.get(note_id)
+    if note is None:
+        raise HTTPException(status_code=404, detail="Note not found")
+    return {"title": note.title, "pending": pending}
 
 
 @app.post("/edit-message")
@@ -248,8 +455,9 @@ async def edit_message(request: EditMessageRequest):
         if not success:
             raise HTTPException(status_code=404, detail="Message not found")
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
+        # The live chat session no longer matches the stored history
+        if ai_service:
+            ai_service.forget_chat(request.annotation_id)
         
         return {"status": "ok"}
     
@@ -272,8 +480,9 @@ async def delete_message(request: DeleteMessageRequest):
         if not success:
             raise HTTPException(status_code=404, detail="Message not found")
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
+        # The live chat session no longer matches the stored history
+        if ai_service:
+            ai_service.forget_chat(request.annotation_id)
         
         return {"status": "ok"}
     
@@ -295,8 +504,8 @@ async def delete_annotation(request: DeleteAnnotationRequest):
         if not success:
             raise HTTPException(status_code=404, detail="Annotation not found")
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
+        if ai_service:
+            ai_service.forget_chat(request.annotation_id)
         
         return {"status": "ok"}
     
@@ -310,22 +519,33 @@ async def delete_annotation(request: DeleteAnnotationRequest):
 async def load_chat(request: LoadChatRequest):
     """Load chat data for a PDF from its .chat file."""
     try:
-        chat_file = chat_storage.load(request.pdf_path)
+        chat_data = await chat_storage.load_json_async(request.pdf_path)
         
-        if chat_file is None:
+        if chat_data is None:
             return {"chat_data": None}
         
-        return {"chat_data": chat_file.to_dict()}
+        # The storage keeps the chat file already encoded, so only the
+        # wrapping object is added here
+        return Response(b'{"chat_data":' + chat_data + b'}', media_type="application/json")
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/chat-image")
+async def get_chat_image(pdf_path: str, name: str):
+    """Serve a screenshot stored alongside a PDF's .chat file."""
+    path = chat_storage.get_image_path(pdf_path, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(path, media_type="image/png")
+
+
 @app.post("/save-chat")
 async def save_chat(request: SaveChatRequest):
     """Manually save chat data (auto-save is default, but this allows explicit saves)."""
     try:
-        chat_storage.save(request.pdf_path)
+        await chat_storage.flush(request.pdf_path)
         return {"status": "ok"}
     
     except Exception as e:
@@ -350,10 +570,7 @@ async def create_note(request: CreateNoteRequest):
             content=request.content
         )
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
-        
-        return {"status": "ok", "note": note.to_dict()}
+        return MsgspecJSONResponse({"status": "ok", "note": note})
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -363,44 +580,42 @@ async def create_note(request: CreateNoteRequest):
 async def update_note(request: UpdateNoteRequest):
     """Update a note's content."""
     try:
-        # Get the note first to access selected_text for title generation
-        chat_file = chat_storage.get_or_create_chat_file(request.pdf_path)
-        note = chat_file.notes.get(request.note_id)
-        
-        if not note:
-            raise HTTPException(status_code=404, detail="Note not found")
-        
-        # Generate title if requested and note doesn't have one yet
-        generated_title = None
-        if request.generate_title and not note.title and ai_service and ai_service.is_configured():
-            try:
-                # Generate a short title based on the highlighted text
-                generated_title = await ai_service.generate_note_title(
-                    selected_text=note.selected_text,
-                    note_content=request.content if request.content else ""
-                )
-            except Exception as e:
-                print(f"Error generating note title: {e}")
-                # Not critical, continue without title
-        
-        success = chat_storage.update_note(
+        updated_note = chat_storage.update_note(
             pdf_path=request.pdf_path,
             note_id=request.note_id,
             content_type=request.content_type,
-            content=request.content,
-            title=generated_title
+            content=request.content
         )
         
-        if not success:
+        if updated_note is None:
             raise HTTPException(status_code=404, detail="Note not found")
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
-        
-        # Get updated note
-        updated_note = chat_file.notes.get(request.note_id)
-        
-        return {"status": "ok", "title": generated_title, "note": updated_note.to_dict() if updated_note else None}
+        # Generate a title if requested and the note doesn't have one yet. It
+        # can take a while (minutes in Batch Mode), so the content is saved
+        # first and the frontend fetches the title from /note-title.
+        key = ("note", request.pdf_path, request.note_id)
+        title_pending = key in app.state.title_tasks
+        if (
+            request.generate_title
+            and not updated_note.title
+            and not title_pending
+            and ai_service
+            and ai_service.is_configured()
+        ):
+            _start_title_task(key, _generate_note_title(
+                request.pdf_path,
+                request.note_id,
+                updated_note.selected_text,
+                request.content or ""
+            ))
+            title_pending = True
+        
+        return MsgspecJSONResponse({
+            "status": "ok",
+            "title": updated_note.title,
+            "title_pending": title_pending,
+            "note": updated_note
+        })
     
     except HTTPException:
         raise
@@ -420,9 +635,6 @@ async def delete_note(request: DeleteNoteRequest):
         if not success:
             raise HTTPException(status_code=404, detail="Note not found")
         
-        # Auto-save
-        chat_storage.save(request.pdf_path)
-        
         return {"status": "ok"}
     
     except HTTPException:
@@ -435,31 +647,82 @@ async def delete_note(request: DeleteNoteRequest):
 async def extract_page_image(
     pdf_path: str = Form(...),
     page_number: int = Form(...),
-    scale: float = Form(2.0)
+    scale: float = Form(2.0),
+    format: str = Form("webp")
 ):
-    """Extract a page from PDF as an image."""
+    """Extract a page from PDF as an image: "webp" (default), "jpeg" or "png"."""
+    if format not in PAGE_IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported image format: {format}")
+    
     try:
-        import fitz  # PyMuPDF
-        
-        doc = fitz.open(pdf_path)
-        page = doc[page_number]
-        
-        # Render at higher resolution
-        mat = fitz.Matrix(scale, scale)
-        pix = page.get_pixmap(matrix=mat)
-        
-        # Convert to base64
-        img_bytes = pix.tobytes("png")
-        img_base64 = base64.b64encode(img_bytes).decode('utf-8')
-        
-        doc.close()
-        
-        return {"image_base64": img_base64}
+        # Rendering is blocking CPU work; keep it off the event loop
+        img_bytes = await anyio.to_thread.run_sync(_render_page_image, pdf_path, page_number, scale, format)
+        return Response(content=img_bytes, media_type=PAGE_IMAGE_FORMATS[format])
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class _DocumentCache(LRUCache):
+    """LRU cache of open PDF documents that closes them on eviction."""
+    
+    def popitem(self):
+        key, doc = super().popitem()
+        doc.close()
+        return key, doc
+
+
+# Documents are keyed by (path, mtime) and pages by (path, mtime, page,
+# scale, format), so a PDF changed on disk is opened afresh
+_page_documents = _DocumentCache(maxsize=PAGE_DOCUMENT_CACHE_SIZE)
+_page_images = LRUCache(maxsize=PAGE_IMAGE_CACHE_SIZE)
+# PyMuPDF isn't thread-safe, and the caches are shared between threads
+_render_lock = threading.Lock()
+
+
+def _render_page_image(pdf_path: str, page_number: int, scale: float, format: str) -> bytes:
+    """Render a PDF page as an image in one of PAGE_IMAGE_FORMATS."""
+    import fitz  # PyMuPDF
+    
+    mtime = os.path.getmtime(pdf_path)
+    image_key = (pdf_path, mtime, page_number, scale, format)
+    
+    with _render_lock:
+        img_bytes = _page_images.get(image_key)
+        if img_bytes is None:
+            doc = _page_documents.get((pdf_path, mtime))
+            if doc is None:
+                doc = fitz.open(pdf_path)
+                _page_documents[(pdf_path, mtime)] = doc
+            page = doc[page_number]
+            
+            # Render at higher resolution
+            mat = fitz.Matrix(scale, scale)
+            pix = page.get_pixmap(matrix=mat, alpha=False)
+            img_bytes = _encode_pixmap(pix, format)
+            _page_images[image_key] = img_bytes
+    
+    return img_bytes
+
+
+def _encode_pixmap(pix, format: str) -> bytes:
+    """Encode a rendered RGB page as WebP, JPEG or PNG."""
+    if format == "webp":
+        # PyMuPDF can't write WebP itself
+        from PIL import Image
+        
+        buffer = io.BytesIO()
+        image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+        image.save(buffer, "WEBP", quality=PAGE_IMAGE_QUALITY)
+        return buffer.getvalue()
+    if format == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=PAGE_IMAGE_QUALITY)
+    return pix.tobytes("png")
+
+
 if __name__ == "__main__":
     import uvicorn
+    # uvicorn[standard] picks uvloop and httptools where they're available
+    # (uvloop has no Windows build). Keep to one worker: chat files are
+    # cached and saved from this process.
     uvicorn.run(app, host="127.0.0.1", port=8765)
@@ -0,0 +1,166 @@
+"""Tests for AIService against a stubbed Gemini client."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import ai_service
+from ai_service import AIService
+
+
+class FakeChat:
+    """Stands in for genai's AsyncChat, streaming canned answers."""
+    
+    def __init__(self, history, chunks):
+        self.history = list(history)
+        self.chunks = chunks
+        self.sent = []
+    
+    def get_history(self):
+        return self.history
+    
+    async def send_message_stream(self, parts):
+        self.sent.append(parts)
+        
+        async def stream():
+            self.history.append("user")
+            for text in self.chunks:
+                if isinstance(text, Exception):
+                    raise text
+                # Like genai, each streamed chunk becomes its own history entry
+                self.history.append(text)
+                yield SimpleNamespace(text=text)
+        
+        return stream()
+
+
+class FakeChats:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.created = []
+    
+    def create(self, model, config, history):
+        chat = FakeChat(history, self.chunks)
+        self.created.append(chat)
+        return chat
+
+
+@pytest.fixture
+def service(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    service = AIService()
+    service.gemini_client = SimpleNamespace(aio=SimpleNamespace(chats=FakeChats(["An ", "answer ", "here."])))
+    
+    async def no_cache():
+        return None
+    
+    monkeypatch.setattr(service, "_get_prompt_cache", no_cache)
+    return service
+
+
+async def ask(service, question, chat_history):
+    return "".join([text async for text in service.ask(question, chat_history=chat_history, annotation_id="a1")])
+
+
+@pytest.mark.asyncio
+async def test_session_is_reused_across_streamed_turns(service):
+    history = []
+    for question in ["First?", "Second?", "Third?"]:
+        answer = await ask(service, question, history)
+        assert answer == "An answer here."
+        history += [
+            {"role": "user", "content": question},
+            {"role": "assistant", "content": answer}
+        ]
+    
+    created = service.gemini_client.aio.chats.created
+    assert len(created) == 1
+    assert len(created[0].sent) == 3
+
+
+@pytest.mark.asyncio
+async def test_session_is_restarted_when_history_changes(service):
+    await ask(service, "First?", [])
+    # An edited or deleted message leaves a history the session doesn't match
+    await ask(service, "Second?", [])
+    
+    assert len(service.gemini_client.aio.chats.created) == 2
+
+
+@pytest.mark.asyncio
+async def test_title_is_none_when_the_answer_fails(service):
+    chunks = ["x" * ai_service.TITLE_ANSWER_CHARS, RuntimeError("stream broke")]
+    service.gemini_client.aio.chats = FakeChats(chunks)
+    
+    async def slow_title(question, answer):
+        await asyncio.sleep(10)
+        return "Too Late"
+    
+    service.generate_title = slow_title
+    stream, title = service.ask_and_title("What?", annotation_id="a1")
+    with pytest.raises(RuntimeError):
+        async for _ in stream:
+            pass
+    
+    # The title was already being generated when the answer failed
+    assert await asyncio.wait_for(title, 1) is None
+
+
+@pytest.mark.parametrize("text, title", [
+    ("Define entropy", "Entropy"),
+    ("What is a Banach space?", "Banach Space"),
+    ("What is this?", None),
+    ("How does this work?", None),
+])
+def test_heuristic_title(text, title):
+    assert ai_service._heuristic_title(text) == title
+
+
+class FakeCaches:
+    """Counts cache creation calls, failing them with the given error."""
+    
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+    
+    async def create(self, model, config):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return SimpleNamespace(name=f"cachedContents/{self.calls}")
+
+
+@pytest.fixture
+def cache_service(monkeypatch):
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    service = AIService()
+    service.gemini_client = SimpleNamespace(aio=SimpleNamespace(caches=FakeCaches()))
+    return service
+
+
+@pytest.mark.asyncio
+async def test_short_prompt_is_not_cached(cache_service):
+    assert await cache_service._get_prompt_cache() is None
+    assert cache_service.gemini_client.aio.caches.calls == 0
+
+
+@pytest.mark.asyncio
+async def test_prompt_cache_is_reused(cache_service):
+    cache_service.system_prompt = "x" * ai_service.PROMPT_CACHE_MIN_TOKENS * ai_service.PROMPT_CACHE_CHARS_PER_TOKEN
+    assert await cache_service._get_prompt_cache() == "cachedContents/1"
+    assert await cache_service._get_prompt_cache() == "cachedContents/1"
+
+
+@pytest.mark.asyncio
+async def test_failed_prompt_cache_is_retried_later(cache_service):
+    cache_service.system_prompt = "x" * ai_service.PROMPT_CACHE_MIN_TOKENS * ai_service.PROMPT_CACHE_CHARS_PER_TOKEN
+    caches = FakeCaches(error=ConnectionError("network down"))
+    cache_service.gemini_client.aio.caches = caches
+    assert await cache_service._get_prompt_cache() is None
+    assert await cache_service._get_prompt_cache() is None
+    assert caches.calls == 1
+    
+    # Once the retry delay has passed
+    caches.error = None
+    cache_service._prompt_cache_retry_at.clear()
+    assert await cache_service._get_prompt_cache() == "cachedContents/2"
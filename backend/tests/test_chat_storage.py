@@ -0,0 +1,246 @@
+"""Tests for the journaled .chat file storage."""
+import os
+import time
+import base64
+import asyncio
+
+import msgspec
+import pytest
+
+import chat_storage
+from chat_storage import ChatStorage, Message
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    return str(tmp_path / "paper.pdf")
+
+
+def chat_path(pdf_path):
+    return pdf_path[:-len(".pdf")] + ".chat"
+
+
+def journal_path(pdf_path):
+    return chat_path(pdf_path) + ".log"
+
+
+def image_dir(pdf_path):
+    return chat_path(pdf_path) + ".d"
+
+
+def slow_down(monkeypatch, storage, method, delay, after=False):
+    """Make one of a ChatStorage's file writing methods take `delay` seconds
+    longer, before it writes anything or once it has."""
+    original = getattr(storage, method)
+    
+    def slow(*args):
+        if not after:
+            time.sleep(delay)
+        result = original(*args)
+        if after:
+            time.sleep(delay)
+        return result
+    
+    monkeypatch.setattr(storage, method, slow)
+
+
+def make_chat(storage, pdf_path):
+    """Fill a chat file with an annotation, a message exchange and a note.
+    
+    Without a running event loop, every change is saved right away.
+    """
+    storage.get_or_create_annotation(pdf_path, "a1", page_number=1)
+    storage.add_messages(pdf_path, "a1", [
+        Message(role="user", content="What is this?"),
+        Message(role="assistant", content="A theorem.")
+    ])
+    storage.set_annotation_title(pdf_path, "a1", "A Theorem")
+    storage.create_note(pdf_path, "n1", page_number=2, selected_text="Lemma 3")
+    storage.update_note(pdf_path, "n1", content="Check the proof")
+
+
+def test_changes_are_journaled_and_replayed(pdf_path):
+    storage = ChatStorage()
+    make_chat(storage, pdf_path)
+    
+    # The first save writes the snapshot; the rest go to the journal
+    with open(journal_path(pdf_path), "rb") as f:
+        assert len(f.read().splitlines()) == 4
+    
+    chat_file = ChatStorage().load(pdf_path)
+    annotation = chat_file.annotations["a1"]
+    assert annotation.title == "A Theorem"
+    assert [m.content for m in annotation.messages] == ["What is this?", "A theorem."]
+    assert chat_file.notes["n1"].content == "Check the proof"
+    assert chat_file.journal_seq == 5
+
+
+def test_replay_skips_records_already_in_snapshot(pdf_path):
+    storage = ChatStorage()
+    make_chat(storage, pdf_path)
+    with open(journal_path(pdf_path), "rb") as f:
+        journal = f.read()
+    
+    # A crash between writing the snapshot and removing the journal
+    storage.save(pdf_path, compact=True)
+    with open(journal_path(pdf_path), "wb") as f:
+        f.write(journal)
+    
+    chat_file = ChatStorage().load(pdf_path)
+    assert len(chat_file.annotations["a1"].messages) == 2
+
+
+def test_torn_record_is_cut_off(pdf_path):
+    storage = ChatStorage()
+    make_chat(storage, pdf_path)
+    size = os.path.getsize(journal_path(pdf_path))
+    with open(journal_path(pdf_path), "ab") as f:
+        f.write(b'{"op": "add_messages", "annot')
+    
+    storage = ChatStorage()
+    chat_file = storage.load(pdf_path)
+    assert len(chat_file.annotations["a1"].messages) == 2
+    assert os.path.getsize(journal_path(pdf_path)) == size
+    
+    # Records appended afterwards aren't stuck behind the torn one
+    storage.add_messages(pdf_path, "a1", [Message(role="user", content="Why?")])
+    chat_file = ChatStorage().load(pdf_path)
+    assert [m.content for m in chat_file.annotations["a1"].messages][-1] == "Why?"
+
+
+def test_long_journal_is_compacted(pdf_path, monkeypatch):
+    monkeypatch.setattr(chat_storage, "JOURNAL_COMPACT_RECORDS", 3)
+    storage = ChatStorage()
+    storage.get_or_create_annotation(pdf_path, "a1", page_number=1)
+    for i in range(5):
+        storage.add_messages(pdf_path, "a1", [Message(role="user", content=str(i))])
+    
+    with open(journal_path(pdf_path), "rb") as f:
+        assert len(f.read().splitlines()) < 3
+    with open(chat_path(pdf_path), "rb") as f:
+        snapshot = msgspec.json.decode(f.read())
+    assert snapshot["journal_seq"] >= 4
+    
+    chat_file = ChatStorage().load(pdf_path)
+    assert [m.content for m in chat_file.annotations["a1"].messages] == ["0", "1", "2", "3", "4"]
+
+
+def test_failed_snapshot_write_leaves_old_snapshot(pdf_path, monkeypatch):
+    storage = ChatStorage()
+    make_chat(storage, pdf_path)
+    storage.save(pdf_path, compact=True)
+    with open(chat_path(pdf_path), "rb") as f:
+        snapshot = f.read()
+    
+    def fail(src, dst):
+        raise OSError("disk full")
+    
+    monkeypatch.setattr(os, "replace", fail)
+    storage.delete_annotation(pdf_path, "a1")
+    assert not storage.save(pdf_path, compact=True)
+    
+    with open(chat_path(pdf_path), "rb") as f:
+        assert f.read() == snapshot
+    assert not [name for name in os.listdir(os.path.dirname(pdf_path)) if name.endswith(".tmp")]
+
+
+def test_inline_images_are_migrated(pdf_path):
+    legacy = {
+        "pdf_path": pdf_path,
+        "pdf_name": "paper",
+        "annotations": {
+            "a1": {
+                "id": "a1",
+                "page_number": 1,
+                "image_base64": base64.b64encode(b"annotation png").decode(),
+                "messages": [{
+                    "id": "m1",
+                    "role": "user",
+                    "content": "What is this?",
+                    "image_base64": base64.b64encode(b"message png").decode()
+                }]
+            }
+        }
+    }
+    with open(chat_path(pdf_path), "wb") as f:
+        f.write(msgspec.json.encode(legacy))
+    
+    storage = ChatStorage()
+    annotation = storage.load(pdf_path).annotations["a1"]
+    assert annotation.image_path == "a1.png"
+    assert annotation.messages[0].image_path == "m1.png"
+    assert ChatStorage().get_image_bytes(pdf_path, "a1.png") == b"annotation png"
+    assert ChatStorage().get_image_bytes(pdf_path, "m1.png") == b"message png"
+    
+    # The snapshot is rewritten without the inline images
+    with open(chat_path(pdf_path), "rb") as f:
+        assert b"image_base64" not in f.read()
+
+
+def test_unused_images_are_removed_on_compaction(pdf_path):
+    storage = ChatStorage()
+    storage.get_or_create_annotation(pdf_path, "a1", page_number=1, image=b"png 1")
+    storage.get_or_create_annotation(pdf_path, "a2", page_number=1, image=b"png 2")
+    storage.delete_annotation(pdf_path, "a1")
+    
+    storage.save(pdf_path, compact=True)
+    assert os.listdir(image_dir(pdf_path)) == ["a2.png"]
+
+
+def test_external_changes_are_reloaded(pdf_path):
+    storage = ChatStorage()
+    make_chat(storage, pdf_path)
+    assert storage.load(pdf_path) is storage.load(pdf_path)
+    
+    other = ChatStorage()
+    other.set_annotation_title(pdf_path, "a1", "Renamed")
+    assert storage.load(pdf_path).annotations["a1"].title == "Renamed"
+
+
+@pytest.mark.asyncio
+async def test_changes_during_a_write_are_saved(pdf_path, monkeypatch):
+    monkeypatch.setattr(chat_storage, "SAVE_DEBOUNCE_DELAY", 0.01)
+    storage = ChatStorage()
+    slow_down(monkeypatch, storage, "_write", 0.2)
+    
+    storage.get_or_create_annotation(pdf_path, "a1", page_number=1)
+    await asyncio.sleep(0.1)  # The first save is being written now
+    storage.add_messages(pdf_path, "a1", [Message(role="user", content="During")])
+    await asyncio.sleep(0.6)
+    
+    assert not storage._dirty
+    chat_file = ChatStorage().load(pdf_path)
+    assert [m.content for m in chat_file.annotations["a1"].messages] == ["During"]
+
+
+@pytest.mark.asyncio
+async def test_images_added_during_a_snapshot_write_are_kept(pdf_path, monkeypatch):
+    storage = ChatStorage()
+    await storage.get_or_create_annotation_async(pdf_path, "a1", page_number=1, image=b"png 1")
+    await storage.flush()
+    # a2.png is on disk before the snapshot write lists the folder, but its
+    # annotation only exists after that save is done
+    slow_down(monkeypatch, storage, "_write", 0.1)
+    slow_down(monkeypatch, storage, "_write_image_file", 0.3, after=True)
+    
+    save = asyncio.create_task(storage.save_async(pdf_path, compact=True))
+    await asyncio.sleep(0.05)
+    await storage.get_or_create_annotation_async(pdf_path, "a2", page_number=1, image=b"png 2")
+    await save
+    await storage.close()
+    
+    assert sorted(os.listdir(image_dir(pdf_path))) == ["a1.png", "a2.png"]
+    assert await ChatStorage().get_image_bytes_async(pdf_path, "a2.png") == b"png 2"
+
+
+@pytest.mark.asyncio
+async def test_flush_waits_for_a_save_being_written(pdf_path, monkeypatch):
+    monkeypatch.setattr(chat_storage, "SAVE_DEBOUNCE_DELAY", 0.01)
+    storage = ChatStorage()
+    slow_down(monkeypatch, storage, "_write", 0.3)
+    
+    storage.get_or_create_annotation(pdf_path, "a1", page_number=1)
+    await asyncio.sleep(0.1)  # The debounced save is being written now
+    await storage.flush(pdf_path)
+    
+    assert "a1" in ChatStorage().load(pdf_path).annotations
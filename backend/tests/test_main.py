@@ -0,0 +1,61 @@
+"""Tests for the /ask endpoint with a stubbed AI service."""
+import json
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+class FakeAIService:
+    """Answers in a few chunks and titles the exchange."""
+    
+    def is_configured(self):
+        return True
+    
+    def ask_and_title(self, question, image, context, chat_history, annotation_id, with_title):
+        title = asyncio.get_running_loop().create_future()
+        
+        async def stream():
+            for text in ["The ", "answer."]:
+                yield text
+            title.set_result("A Title" if with_title else None)
+        
+        return stream(), title
+    
+    async def aclose(self):
+        pass
+
+
+@pytest.fixture
+def client(monkeypatch):
+    with TestClient(main.app) as client:
+        monkeypatch.setattr(main, "ai_service", FakeAIService())
+        yield client
+
+
+def ask(client, **request):
+    response = client.post("/ask", data={"request": json.dumps(request)})
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_ask_streams_and_stores_the_exchange(client, tmp_path):
+    pdf_path = str(tmp_path / "paper.pdf")
+    events = ask(client, pdf_path=pdf_path, annotation_id="a1", question="What?", page_number=1)
+    
+    assert [e["text"] for e in events if e["type"] == "chunk"] == ["The ", "answer."]
+    done = events[-1]
+    assert done["type"] == "done"
+    assert done["response"] == "The answer."
+    assert done["title"] == "A Title"
+    
+    annotation = main.chat_storage.get_annotation(pdf_path, "a1")
+    assert annotation.title == "A Title"
+    assert [(m.role, m.content) for m in annotation.messages] == [("user", "What?"), ("assistant", "The answer.")]
+
+
+def test_ask_rejects_invalid_requests(client):
+    response = client.post("/ask", data={"request": json.dumps({"question": "What?"})})
+    assert response.status_code == 422
@@ -155,6 +155,28 @@ function generateId() {
     return 'ann_' + Date.now() + '_' + Math.random().toString(36).substr(2, 9);
 }
 
+// Decode a base64 string into a Blob
+function base64ToBlob(base64, type) {
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return new Blob([bytes], { type });
+}
+
+// Screenshot URL: inline data for a new selection, otherwise the stored file
+function annotationImageSrc(annotation) {
+    if (annotation.image_base64) {
+        return `data:image/png;base64,${annotation.image_base64}`;
+    }
+    if (annotation.image_path) {
+        const params = new URLSearchParams({ pdf_path: state.pdfPath, name: annotation.image_path });
+        return `${state.backendUrl}/chat-image?${params}`;
+    }
+    return null;
+}
+
 // Markdown and LaTeX rendering
 function renderMarkdown(text) {
     // First, protect LaTeX expressions
@@ -361,6 +383,51 @@ async function apiRequest(endpoint, data) {
     return response.json();
 }
 
+// POST to an endpoint that streams newline-delimited JSON events.
+// Calls onEvent for each intermediate event and resolves with the final 'done' event.
+async function apiStreamRequest(endpoint, data, onEvent) {
+    // FormData goes as multipart (for file uploads), anything else as JSON
+    const isForm = data instanceof FormData;
+    const response = await fetch(`${state.backendUrl}${endpoint}`, {
+        method: 'POST',
+        headers: isForm ? {} : { 'Content-Type': 'application/json' },
+        body: isForm ? data : JSON.stringify(data)
+    });
+
+    if (!response.ok) {
+        const error = await response.json();
+        throw new Error(error.detail || 'API request failed');
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        let newline;
+        while ((newline = buffer.indexOf('\n')) >= 0) {
+            const line = buffer.slice(0, newline).trim();
+            buffer = buffer.slice(newline + 1);
+            if (!line) continue;
+
+            const event = JSON.parse(line);
+            if (event.type === 'error') {
+                throw new Error(event.detail || 'API request failed');
+            }
+            if (event.type === 'done') {
+                return event;
+            }
+            onEvent(event);
+        }
+    }
+
+    throw new Error('Response ended unexpectedly');
+}
+
 // ============================================
 // PDF Loading and Rendering
 // ============================================
@@ -947,7 +1014,9 @@ async function handleSelectionEnd(e) {
         bounding_box: boundingBox,
         image_base64: imageData,
         messages: [],
-        created_at: new Date().toISOString()
+        created_at: new Date().toISOString(),
+        // Not stored by the backend until its first question is answered
+        unsaved: true
     };
 
     // Update UI and open chat
@@ -1046,7 +1115,7 @@ function renderAnnotationOverlay(annotation) {
     }
 
     // Screenshot annotation - has image and bounding box
-    if (annotation.image_base64 && annotation.bounding_box) {
+    if ((annotation.image_base64 || annotation.image_path) && annotation.bounding_box) {
         overlay.classList.add('screenshot-annotation');
 
         const scale = state.renderScale;
@@ -1254,8 +1323,9 @@ function createFloatingAnnotation(annotation) {
 
     // Preview content
     let previewHtml = '';
-    if (annotation.image_base64) {
-        previewHtml = `<img src="data:image/png;base64,${annotation.image_base64}" alt="Selection">`;
+    const imageSrc = annotationImageSrc(annotation);
+    if (imageSrc) {
+        previewHtml = `<img src="${imageSrc}" alt="Selection">`;
     } else if (annotation.selected_text) {
         previewHtml = `<p>${escapeHtml(annotation.selected_text)}</p>`;
     }
@@ -1482,8 +1552,9 @@ function createAnnotationCard(annotation) {
 
     // Preview image
     let previewHtml = '';
-    if (annotation.image_base64) {
-        previewHtml = `<img class="annotation-preview-image" src="data:image/png;base64,${annotation.image_base64}" alt="Selection">`;
+    const imageSrc = annotationImageSrc(annotation);
+    if (imageSrc) {
+        previewHtml = `<img class="annotation-preview-image" src="${imageSrc}" alt="Selection">`;
     } else if (annotation.selected_text) {
         previewHtml = `<p class="annotation-preview">${escapeHtml(annotation.selected_text)}</p>`;
     }
@@ -1557,8 +1628,9 @@ function openAnnotationChat(annotationId) {
     elements.chatTitle.textContent = title;
 
     // Show preview
-    if (annotation.image_base64) {
-        elements.chatPreviewImage.src = `data:image/png;base64,${annotation.image_base64}`;
+    const imageSrc = annotationImageSrc(annotation);
+    if (imageSrc) {
+        elements.chatPreviewImage.src = imageSrc;
         elements.chatPreviewImage.style.display = 'block';
         elements.chatPreviewText.style.display = 'none';
     } else if (annotation.selected_text) {
@@ -1713,6 +1785,15 @@ async function sendMessage() {
     // Disable send button
     elements.btnSend.disabled = true;
 
+    // Assistant message, filled in as the answer streams in
+    const assistantMessage = {
+        id: generateId(),
+        role: 'assistant',
+        content: '',
+        timestamp: new Date().toISOString()
+    };
+    let assistantContentEl = null;
+
     try {
         // Build chat history (without the current message)
         const chatHistory = annotation.messages.slice(0, -1).map(m => ({
@@ -1720,39 +1801,61 @@ async function sendMessage() {
             content: m.content
         }));
 
-        // Send to backend
-        const response = await apiRequest('/ask', {
+        // Send to backend, with the screenshot as a file upload
+        const form = new FormData();
+        form.append('request', JSON.stringify({
             pdf_path: state.pdfPath,
             annotation_id: annotation.id,
             question: question,
-            image_base64: annotation.image_base64 || null,
             bounding_box: annotation.bounding_box || null,
             selected_text: annotation.selected_text || null,
             page_number: annotation.page_number,
             chat_history: chatHistory.length > 0 ? chatHistory : null
+        }));
+        // The backend keeps the screenshot once the annotation is stored
+        if (annotation.unsaved && annotation.image_base64) {
+            form.append('image', base64ToBlob(annotation.image_base64, 'image/png'), 'selection.png');
+        }
+
+        const response = await apiStreamRequest('/ask', form, (event) => {
+            if (event.type !== 'chunk') return;
+
+            // Swap the typing indicator for the answer on the first chunk
+            if (!assistantContentEl) {
+                removeTypingIndicator();
+                annotation.messages.push(assistantMessage);
+                const messageEl = createMessageElement(assistantMessage);
+                elements.chatMessages.appendChild(messageEl);
+                assistantContentEl = messageEl.querySelector('.message-content');
+            }
+
+            assistantMessage.content += event.text;
+            assistantContentEl.innerHTML = renderMarkdown(assistantMessage.content);
+            elements.chatMessages.scrollTop = elements.chatMessages.scrollHeight;
         });
 
         // Remove typing indicator
         removeTypingIndicator();
 
-        // Add assistant message
-        const assistantMessage = {
-            id: response.assistant_message_id,
-            role: 'assistant',
-            content: response.response,
-            timestamp: new Date().toISOString()
-        };
-        annotation.messages.push(assistantMessage);
+        // Use the stored message from the server
+        delete annotation.unsaved;
+        assistantMessage.id = response.assistant_message_id;
+        assistantMessage.content = response.response;
+        if (!annotation.messages.includes(assistantMessage)) {
+            annotation.messages.push(assistantMessage);
+        }
 
         // Update local message IDs from server
         if (response.user_message_id) {
             userMessage.id = response.user_message_id;
         }
 
-        // Update title if returned by backend
+        // Update title if returned by backend, or fetch it once it's generated
         if (response.title) {
             annotation.title = response.title;
             elements.chatTitle.textContent = response.title;
+        } else if (response.title_pending) {
+            fetchAnnotationTitle(annotation);
         }
 
         // Re-render messages
@@ -1763,6 +1866,12 @@ async function sendMessage() {
         removeTypingIndicator();
         console.error('Error sending message:', error);
 
+        // Drop any partially streamed answer - it was never stored
+        const partialIndex = annotation.messages.indexOf(assistantMessage);
+        if (partialIndex >= 0) {
+            annotation.messages.splice(partialIndex, 1);
+        }
+
         // Show error in chat
         const errorMessage = {
             id: generateId(),
@@ -1777,6 +1886,50 @@ async function sendMessage() {
     elements.btnSend.disabled = false;
 }
 
+// Wait for a title the backend is still generating. Each request waits a
+// while on the backend, so keep asking until it's done (Batch Mode titles
+// can take minutes). Resolves with the title, or null if there is none or
+// another PDF was opened meanwhile.
+async function fetchPendingTitle(endpoint, params) {
+    const pdfPath = state.pdfPath;
+    const query = new URLSearchParams({ pdf_path: pdfPath, ...params });
+    try {
+        while (state.pdfPath === pdfPath) {
+            const response = await fetch(`${state.backendUrl}${endpoint}?${query}`);
+            if (!response.ok) return null;
+
+            const { title, pending } = await response.json();
+            if (title || !pending) {
+                return state.pdfPath === pdfPath ? title : null;
+            }
+        }
+    } catch (error) {
+        console.error(`Error fetching title from ${endpoint}:`, error);
+    }
+    return null;
+}
+
+// Show an annotation's title once the backend has generated it
+async function fetchAnnotationTitle(annotation) {
+    const title = await fetchPendingTitle('/annotation-title', { annotation_id: annotation.id });
+    if (!title) return;
+
+    annotation.title = title;
+    if (state.currentAnnotationId === annotation.id) {
+        elements.chatTitle.textContent = title;
+    }
+    updateAnnotationsList();
+}
+
+// Show a note's title once the backend has generated it
+async function fetchNoteTitle(note) {
+    const title = await fetchPendingTitle('/note-title', { note_id: note.id });
+    if (!title) return;
+
+    note.title = title;
+    updateNotesList();
+}
+
 // Make these functions global for onclick handlers
 window.editMessage = async function (messageId) {
     const annotation = state.annotations[state.currentAnnotationId];
@@ -2436,6 +2589,10 @@ async function saveCurrentNote(showErrors = true) {
         note.content = content;
         if (result.title) {
             note.title = result.title;
+        } else if (result.title_pending && !note.titlePending) {
+            // Only one fetch per note, however often the autosave fires
+            note.titlePending = true;
+            fetchNoteTitle(note).finally(() => { delete note.titlePending; });
         }
 
         updateNotesList();